@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import pikepdf
+
+from utils.document import SourceDocument
+from utils.pdf import set_pdf_metadata
+from utils.repaginate import combine_pages, export_pdf, find_optimal_splits, find_possible_splits, slice_image
+from utils.samsung import extract_sdocx
+
+STAGES = ("rasterize", "split", "slice", "export", "metadata", "sdocx")
+
+INK_COLORS = ("0 0 0", "0 0 0.6", "0.7 0 0", "0 0.5 0")
+
+
+def generate_pdf(filename: str, pages: int = 10, density: float = 0.5, seed: int = 0, blob_size: int = 65536):
+    """Generate a synthetic handwritten-style PDF with embedded Samsung Notes data."""
+
+    rnd = random.Random(seed)
+
+    with pikepdf.new() as pdf:
+        for _ in range(pages):
+            operations = ["1.2 w 1 J 1 j"]
+            y = 800
+
+            while y > 60:
+                # Skipped lines leave whitespace between paragraphs, which the repagination splits on
+                if rnd.random() > density:
+                    y -= rnd.randint(20, 90)
+                    continue
+
+                operations.append(f"{rnd.choice(INK_COLORS)} RG")
+
+                x = rnd.randint(40, 80)
+                end = rnd.randint(300, 550)
+                operations.append(f"{x} {y} m")
+
+                while x < end:
+                    x += rnd.randint(3, 12)
+                    operations.append(f"{x} {y + rnd.randint(-8, 8)} l")
+
+                operations.append("S")
+                y -= 22
+
+            page = pdf.add_blank_page(page_size=(595, 842))
+            page.Contents = pdf.make_stream("\n".join(operations).encode())
+
+        # Samsung Notes data is a compressed archive, so random bytes are a good stand-in
+        blob = pdf.make_stream(rnd.randbytes(blob_size))
+        private = pikepdf.Dictionary(Private=pikepdf.Dictionary(Bin0=blob))
+        pdf.Root.PieceInfo = pikepdf.Dictionary(SPenSDK_PAGE_LIST=private)
+
+        pdf.save(filename)
+
+
+def peak_rss() -> float:
+    """Return the peak resident set size of the current process in MB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports the size in kilobytes and macOS in bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def benchmark_case(filename: str, directory: str, dpi: int | float, height: int | float) -> dict:
+    """Run every stage of the conversion of one file and measure it."""
+
+    results = {}
+    started = time.perf_counter()
+
+    def measure(stage: str):
+        nonlocal started
+        finished = time.perf_counter()
+        results[stage] = {"time": finished - started, "peak_rss": peak_rss()}
+        started = finished
+
+    output_pdf = os.path.join(directory, "output.pdf")
+    output_sdocx = os.path.join(directory, "output.sdocx")
+
+    with SourceDocument(filename) as document:
+        combined = combine_pages(document, dpi=dpi)
+        measure("rasterize")
+
+        possible = find_possible_splits(combined)
+        optimal = find_optimal_splits(possible, int(height * dpi / 25.4))
+        measure("split")
+
+        sliced = slice_image(combined, optimal)
+        measure("slice")
+
+        export_pdf(sliced, output_pdf, dpi=dpi)
+        measure("export")
+
+        # Metadata is written together with the export, so only setting it on the open document is measured
+        with pikepdf.open(output_pdf) as pdf:
+            started = time.perf_counter()
+            set_pdf_metadata(
+                pdf, title="Benchmark", author="Benchmark", language="en", converted=time.localtime()
+            )
+            measure("metadata")
+
+        extract_sdocx(document, output_sdocx)
+        measure("sdocx")
+
+    results["output_pages"] = len(sliced)
+    results["output_size"] = os.path.getsize(output_pdf)
+
+    return results
+
+
+def run_case(pages: int, density: float, seed: int, dpi: int | float, height: int | float) -> dict:
+    """Generate a synthetic file and benchmark its conversion."""
+
+    # Logs of the pipeline would interleave with the results
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "input.pdf")
+        generate_pdf(filename, pages=pages, density=density, seed=seed)
+
+        results = benchmark_case(filename, directory, dpi, height)
+        results["input_size"] = os.path.getsize(filename)
+
+    return results
+
+
+def summarize(runs: list[dict]) -> dict:
+    """Combine repeated runs of the same case into a summary."""
+
+    stages = {}
+
+    for stage in STAGES:
+        times = [run[stage]["time"] for run in runs]
+        stages[stage] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "peak_rss": max(run[stage]["peak_rss"] for run in runs),
+        }
+
+    return {
+        "stages": stages,
+        "total": statistics.median(sum(run[stage]["time"] for stage in STAGES) for run in runs),
+        "peak_rss": max(run[stage]["peak_rss"] for run in runs for stage in STAGES),
+        "input_size": runs[0]["input_size"],
+        "output_size": runs[0]["output_size"],
+        "output_pages": runs[0]["output_pages"],
+    }
+
+
+def current_version() -> str | None:
+    """Return the current git commit, if available."""
+
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return result.stdout.strip()
+
+
+@click.command()
+@click.option("--pages", multiple=True, type=int, default=[5, 20], help="Page counts of generated files.")
+@click.option("--density", multiple=True, type=float, default=[0.5], help="Fraction of lines with writing.")
+@click.option("--repeat", default=3, help="Number of runs of each case.")
+@click.option("--dpi", default=300, type=float, help="Rendering resolution.")
+@click.option("--height", default=297, type=float, help="Output page height in millimetres.")
+@click.option("--seed", default=0, help="Seed for generated files.")
+@click.option("--output", type=click.File("w"), default="-", help="Path to the JSON results file.")
+def benchmark(pages, density, repeat, dpi, height, seed, output):
+    """Benchmark the conversion pipeline on synthetic documents."""
+
+    cases = []
+
+    for count in pages:
+        for fraction in density:
+            runs = []
+
+            for _ in range(repeat):
+                # Each run uses a fresh process so the peak memory usage is not shared between runs
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs.append(executor.submit(run_case, count, fraction, seed, dpi, height).result())
+
+            cases.append({"pages": count, "density": fraction, **summarize(runs)})
+            click.echo(f"Benchmarked {count} pages with density {fraction}", err=True)
+
+    results = {
+        "version": current_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"dpi": dpi, "height": height, "repeat": repeat, "seed": seed},
+        "cases": cases,
+    }
+
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,147 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmark import current_version
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that are only needed for converting and rendering, so they shouldn't slow down other commands
+HEAVY_MODULES = ("numpy", "PIL", "pikepdf", "pypdfium2", "jinja2")
+
+CONFIG = """\
+directories:
+  source: {source}
+  target: {target}
+layouts:
+  - name: Notes
+"""
+
+
+def write_config(directory: str) -> str:
+    """Write a config with empty source and target directories."""
+
+    source = os.path.join(directory, "source")
+    target = os.path.join(directory, "target")
+
+    os.makedirs(source)
+    os.makedirs(target)
+
+    filename = os.path.join(directory, "config.yaml")
+
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(CONFIG.format(source=source, target=target))
+
+    return filename
+
+
+def measure_command(args: list[str], ready: str | None = None) -> float:
+    """Measure the time until a command exits, or until it logs a line that marks it as ready."""
+
+    command = [sys.executable, "main.py", *args]
+    started = time.perf_counter()
+
+    if ready is None:
+        subprocess.run(command, cwd=ROOT, capture_output=True, check=True)
+        return time.perf_counter() - started
+
+    process = subprocess.Popen(
+        command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+
+    try:
+        for line in process.stderr:
+            if ready in line:
+                return time.perf_counter() - started
+
+        raise RuntimeError(f"Command exited before it was ready: {' '.join(args)}")
+
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def heavy_imports(args: list[str]) -> list[str]:
+    """Return heavy modules imported by a command that exits on its own."""
+
+    command = [sys.executable, "-X", "importtime", "main.py", *args]
+    result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True)
+
+    imported = set()
+
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:"):
+            imported.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+
+    return sorted(module for module in HEAVY_MODULES if module in imported)
+
+
+@click.command()
+@click.option("--repeat", default=5, help="Number of runs of each command.")
+@click.option("--budget-schema", default=1.0, help="Maximum median time of the schema command in seconds.")
+@click.option("--budget-process", default=1.5, help="Maximum median time of a process run without changes.")
+@click.option("--budget-watch", default=2.0, help="Maximum median time until watching starts.")
+@click.option("--output", type=click.File("w"), default="-", help="Path to the JSON results file.")
+def benchmark(repeat, budget_schema, budget_process, budget_watch, output):
+    """Benchmark the startup time of the CLI commands and check it against the budgets."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = write_config(directory)
+
+        # The first run creates the structure and the indexes, so the measured runs have nothing to do
+        measure_command(["process", "--config", config])
+
+        cases = {
+            "schema": (["schema"], None, budget_schema),
+            "process": (["process", "--config", config], None, budget_process),
+            "watch": (["watch", "--config", config], "Watching for file changes...", budget_watch),
+        }
+
+        commands = {}
+        exceeded = []
+
+        for name, (args, ready, budget) in cases.items():
+            times = [measure_command(args, ready) for _ in range(repeat)]
+
+            commands[name] = {
+                "min": min(times),
+                "median": statistics.median(times),
+                "budget": budget,
+                "heavy_imports": heavy_imports(args) if ready is None else None,
+            }
+
+            if commands[name]["median"] > budget:
+                exceeded.append(f"{name} took {commands[name]['median']:.3f} s, budget is {budget:.3f} s")
+
+            if commands[name]["heavy_imports"]:
+                exceeded.append(f"{name} imported {', '.join(commands[name]['heavy_imports'])}")
+
+            click.echo(f"Benchmarked {name}", err=True)
+
+    results = {
+        "version": current_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {"repeat": repeat},
+        "commands": commands,
+    }
+
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+    for message in exceeded:
+        click.echo(f"Startup budget exceeded: {message}", err=True)
+
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
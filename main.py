@@ -1,285 +1,655 @@
+from __future__ import annotations
+
+import functools
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import signal
 import sys
 import time
+from collections.abc import Container, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 from urllib.parse import urljoin
 
 import click
-from pydantic_yaml import parse_yaml_file_as
 from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
-
-from utils.directories import ensure_structure, wait_ready, walk_layout
-from utils.jinja import prepare_environment
-from utils.models import BaseConfig, BaseMetadata, FileMetadata
-from utils.pdf import set_pdf_metadata
-from utils.repaginate import repaginate_pdf
-from utils.samsung import extract_sdocx
+
+from utils.cache import ConversionCache, PageCache, evict_pages
+from utils.changes import changes
+from utils.hooks import HookRunner, run_hook, write_manifest
+from utils.directories import ensure_structure, find_layout, sync_directory, wait_ready, walk_layout
+from utils.metrics import recorder, stage
+from utils.jinja import prepare_environment, template_digest
+from utils.models import BaseConfig, DirectoryMetadata, FileMetadata
+from utils.readiness import ReadinessTracker
+from utils.scheduler import BatchScheduler
+from utils.static import build_assets, remove_compressed, write_page
+from utils.store import MetadataStore, SqliteMetadataStore
 from utils.text import slugify
+from utils.tree import insert_node
+
+# Conversion dependencies are slow to import, so they are only imported by stages that convert documents
+if TYPE_CHECKING:
+    from utils.document import SourceDocument
 
 
 class SourceHandler(FileSystemEventHandler):
-    def __init__(self, config):
-        self.config = config
+    def __init__(self, tracker: ReadinessTracker):
+        self.tracker = tracker
 
     def on_created(self, event):
         if not event.is_directory and event.src_path.lower().endswith(".pdf"):
-            wait_ready(event.src_path)
-
-            config = parse_yaml_file_as(BaseConfig, self.config)
+            self.tracker.track(event.src_path)
 
-            run_pre_hook(config)
-            handle_source(config)
-            run_post_hook(config)
+    def on_closed(self, event):
+        # Closing a file after writing is only reported on some platforms, others fall back to polling
+        if not event.is_directory:
+            self.tracker.complete(event.src_path)
 
 
 class TargetHandler(FileSystemEventHandler):
-    def __init__(self, config):
-        self.config = config
+    def __init__(self, scheduler: BatchScheduler, target: str):
+        self.scheduler = scheduler
+        self.target = target
 
     def on_deleted(self, event):
-        config = parse_yaml_file_as(BaseConfig, self.config)
+        # Only removed documents need processing, other deletions are caused by our own cleanup and caches
+        if os.path.relpath(event.src_path, self.target).split(os.sep)[0] == ".cache":
+            return
 
-        run_pre_hook(config)
-        handle_target(config)
-        run_post_hook(config)
+        if event.is_directory or event.src_path.lower().endswith(".pdf"):
+            self.scheduler.submit("target", event.src_path)
 
 
 class ConfigHandler(FileSystemEventHandler):
-    def __init__(self, config):
+    def __init__(self, scheduler: BatchScheduler, config: str):
+        self.scheduler = scheduler
         self.config = config
 
     def on_modified(self, event):
         if not event.is_directory and event.src_path == self.config:
-            wait_ready(event.src_path)
+            self.scheduler.submit("config", event.src_path)
 
-            logging.info("Config file changed, reloading...")
 
-            config = parse_yaml_file_as(BaseConfig, self.config)
+def process_batch(
+    configfile: str,
+    previous: BaseConfig,
+    store: MetadataStore,
+    runner: HookRunner,
+    batch: dict[str, set[str]],
+    pending: Container[str] = (),
+) -> tuple[BaseConfig, MetadataStore]:
+    reload = "config" in batch
 
-            run_pre_hook(config)
-            handle_source(config, False)
-            handle_target(config, False)
-            update_metadata(config, False)
-            render_index(config)
-            run_post_hook(config)
+    if reload:
+        wait_ready(configfile)
+        logging.info("Config file changed, reloading...")
 
+    config = load_config(configfile)
+
+    # The metadata, the change log and the hook manifest belong to the target, so they move together with it
+    moved = (config.directories.target, config.metadata) != (previous.directories.target, previous.metadata)
+
+    if moved:
+        logging.info("Metadata location changed, opening metadata in %s", config.directories.target)
+        store = metadata_store(config)
+        changes.configure(config.directories.target)
+        runner.manifest = hook_manifest(config)
+
+    run_pre_hook(config)
+
+    # Full scans are only needed when the config changed or when they are requested explicitly
+    reconcile = reload or moved or "reconcile" in batch
+
+    changed = reconcile
+
+    if reconcile:
+        logging.info("Reconciling all documents...")
+        changed |= handle_source(config, store, False, pending)
+        changed |= handle_target(config, store, False)
+        update_metadata(config, store, False)
+
+    else:
+        if "source" in batch:
+            changed |= handle_source_files(config, store, batch["source"], False)
+
+        if "target" in batch:
+            changed |= handle_target_paths(config, store, batch["target"], False)
+
+    if changed:
+        render_index(config, store)
+
+    store.flush()
+
+    run_post_hook(config, runner)
+
+    recorder.flush()
+
+    return config, store
 
-def handle_source(config: BaseConfig, index=True):
-    ensure_structure(config.layouts, config.directories.source)
-    ensure_structure(config.layouts, config.directories.target)
 
-    metafile = os.path.join(config.directories.target, "metadata.json")
+def parse_document_name(filename: str) -> list[str]:
+    # Strip the duplicate counter and split off the export date and time
+    name = re.sub(r" \(\d+\)$", "", filename[:-4])
+    return name.rsplit("_", 2)
+
+
+def conversion_cache(config: BaseConfig) -> ConversionCache | None:
+    if not config.conversion.cache_size:
+        return None
+
+    directory = os.path.join(config.directories.target, ".cache", "documents")
+    return ConversionCache(directory, config.conversion.cache_size * 1024 * 1024)
+
+
+def page_cache(config: BaseConfig, path: str, slug: str) -> PageCache | None:
+    if not config.conversion.incremental:
+        return None
+
+    directory = os.path.join(config.directories.target, ".cache", "pages", path, slug)
+    return PageCache(directory)
+
+
+def load_config(filename: str) -> BaseConfig:
+    # Commands that don't read the config, like schema, don't need the YAML parser
+    from pydantic_yaml import parse_yaml_file_as
+
+    return parse_yaml_file_as(BaseConfig, filename)
+
+
+def metadata_store(config: BaseConfig) -> MetadataStore:
+    filename = os.path.join(config.directories.target, "metadata.json")
+
+    if config.metadata.backend == "sqlite":
+        os.makedirs(config.directories.target, exist_ok=True)
+        export = filename if config.metadata.export else None
+        return SqliteMetadataStore(os.path.join(config.directories.target, "metadata.db"), filename, export)
+
+    return MetadataStore(filename)
+
+
+def export_document(
+    config: BaseConfig,
+    document: SourceDocument,
+    target: str,
+    slug: str,
+    title: str,
+    modified: time.struct_time,
+    converted: time.struct_time,
+) -> dict:
+    from utils.repaginate import repaginate_pdf
+    from utils.samsung import extract_sdocx
+
+    target_filename_pdf = os.path.join(target, slug + ".pdf")
+    target_filename_sdocx = os.path.join(target, slug + ".sdocx")
+
+    if config.conversion.repaginate:
+        repaginate_pdf(
+            document,
+            target_filename_pdf,
+            dpi=config.conversion.dpi,
+            height=config.conversion.height,
+            streaming=config.conversion.streaming,
+            cache=page_cache(config, os.path.relpath(target, config.directories.target), slug),
+            vector=config.conversion.vector,
+            analysis_dpi=config.conversion.analysis_dpi,
+            encoding=config.conversion.encoding,
+            quality=config.conversion.quality,
+            colors=config.conversion.colors,
+            metadata={
+                "title": title,
+                "author": config.meta.author,
+                "language": config.meta.language,
+                "modified": modified,
+                "converted": converted,
+            },
+        )
 
-    if os.path.isfile(metafile):
-        with open(metafile, encoding="utf-8") as file:
-            metadata = BaseMetadata.model_validate_json(file.read())
     else:
-        metadata = BaseMetadata(root={})
+        shutil.copy2(document.filename, target_filename_pdf)
+
+    sdocx = extract_sdocx(document, target_filename_sdocx)
+
+    return {
+        "modified": time.strftime("%Y-%m-%d %H:%M:%S", modified),
+        "converted": time.strftime("%Y-%m-%d %H:%M:%S", converted),
+        "extensions": ["pdf", "sdocx"] if sdocx else ["pdf"],
+    }
+
+
+def convert_document(config: BaseConfig, source: str, target: str, filename: str) -> FileMetadata | None:
+    from utils.document import SourceDocument
+
+    try:
+        parts = parse_document_name(filename)
+
+        title = parts[0]
+        slug = slugify(title)
+
+        source_filename = os.path.join(source, filename)
+        target_filename_pdf = os.path.join(target, slug + ".pdf")
+        target_filename_sdocx = os.path.join(target, slug + ".sdocx")
+
+        logging.info("Processing: %s", source_filename)
+
+        try:
+            modified = time.strptime(f"{parts[1]}-{parts[2]}", "%y%m%d-%H%M%S")
+        except (IndexError, ValueError):
+            logging.warning("Failed to parse date from filename, using file modification date")
+            modified = time.localtime(os.path.getmtime(os.path.join(source, filename)))
+
+        converted = time.localtime()
+
+        cache = conversion_cache(config)
+        info = None
+
+        with stage("document", source_filename), SourceDocument(source_filename) as document:
+            if cache is not None:
+                key = cache.key(
+                    document,
+                    title=title,
+                    author=config.meta.author,
+                    language=config.meta.language,
+                    conversion=config.conversion.model_dump(
+                        exclude={"workers", "cache_size", "incremental", "incremental_cache_size"}
+                    ),
+                )
+
+                info = cache.load(key, target_filename_pdf, target_filename_sdocx)
+
+            if info is not None:
+                # Cached entries are shared between documents with the same content, so dates are their own
+                info["modified"] = time.strftime("%Y-%m-%d %H:%M:%S", modified)
+                info["converted"] = time.strftime("%Y-%m-%d %H:%M:%S", converted)
+
+                if config.conversion.repaginate:
+                    from utils.pdf import update_pdf_metadata
+
+                    update_pdf_metadata(target_filename_pdf, {"modified": modified, "converted": converted})
+
+                logging.info("Reused cached conversion: %s", target_filename_pdf)
+
+            else:
+                info = export_document(config, document, target, slug, title, modified, converted)
+
+                if cache is not None:
+                    sdocx = target_filename_sdocx if "sdocx" in info["extensions"] else None
+                    cache.store(key, target_filename_pdf, sdocx, info)
+
+                logging.info("Processed: %s", target_filename_pdf)
+
+        return FileMetadata(slug=slug, name=title, **info)
+
+    except Exception as error:
+        logging.exception("Failed to process document: %s", error)
+        return None
+
+
+def convert_documents(config: BaseConfig, source: str, target: str, filenames: list[str]):
+    # Documents with the same target are converted in order by the same worker
+    return [convert_document(config, source, target, filename) for filename in filenames]
+
+
+def convert_documents_worker(config: BaseConfig, source: str, target: str, filenames: list[str]):
+    # Measurements are made in the worker process, so they are returned together with the results
+    return convert_documents(config, source, target, filenames), recorder.collect()
+
+
+def setup_worker(profile: bool, jsonl: str | None, prometheus: str | None):
+    setup_logging()
+
+    recorder.configure(profile, jsonl, prometheus)
+
+
+def add_job(jobs: dict, config: BaseConfig, path: str, pathdata: DirectoryMetadata, filename: str):
+    source = os.path.join(config.directories.source, path)
+    target = os.path.join(config.directories.target, path)
+
+    # Documents with the same target are grouped into one job, so they are converted in order
+    slug = slugify(parse_document_name(filename)[0])
+    job = jobs.setdefault(os.path.join(target, slug), (path, pathdata, source, target, []))
+    job[4].append(filename)
+
+
+def run_jobs(config: BaseConfig, store: MetadataStore, jobs: dict, index=True) -> bool:
+    if not jobs:
+        return False
+
+    workers = config.conversion.workers
+
+    # Only Python 3.13 and newer respect the CPU affinity of the process
+    if workers == -1:
+        workers = getattr(os, "process_cpu_count", os.cpu_count)() or 1
+
+    if workers > 1 and len(jobs) > 1:
+        initargs = (recorder.profile, recorder.jsonl, recorder.prometheus)
+
+        # Watching runs other threads, so workers are started from a clean process instead of forked
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)),
+            mp_context=context,
+            initializer=setup_worker,
+            initargs=initargs,
+        ) as executor:
+            futures = [
+                (job, executor.submit(convert_documents_worker, config, job[2], job[3], job[4]))
+                for job in jobs.values()
+            ]
+
+            results = []
+
+            for job, future in futures:
+                try:
+                    documents, records = future.result()
+                except Exception as error:
+                    # Sources of failed jobs are kept, so they are converted again by the next run
+                    logging.error("Failed to convert documents: %s: %s", ", ".join(job[4]), error)
+                    continue
+
+                recorder.extend(records)
+                results.append((job, documents))
+
+    else:
+        results = [(job, convert_documents(config, job[2], job[3], job[4])) for job in jobs.values()]
+
+    for (path, pathdata, source, _, filenames), documents in results:
+        for filename, document in zip(filenames, documents, strict=True):
+            if document is None:
+                continue
+
+            insert_node(pathdata.content, document.slug, document)
+            store.mark_changed(path, document.slug)
+
+            for extension in document.extensions:
+                changes.written(os.path.join(config.directories.target, path, f"{document.slug}.{extension}"))
+
+            # Sources are only removed once their documents are in the metadata
+            os.remove(os.path.join(source, filename))
+
+    if (cache := conversion_cache(config)) is not None:
+        cache.evict()
+
+    if config.conversion.incremental:
+        directory = os.path.join(config.directories.target, ".cache", "pages")
+        evict_pages(directory, config.conversion.incremental_cache_size * 1024 * 1024)
+
+    if index:
+        render_index(config, store)
 
-    changes = False
+    return True
 
-    for path, pathdata in walk_layout(config.layouts, metadata):
+
+@stage("source")
+def handle_source(config: BaseConfig, store: MetadataStore, index=True, pending: Container[str] = ()) -> bool:
+    ensure_structure(config.layouts, config.directories.source)
+    ensure_structure(config.layouts, config.directories.target)
+
+    metadata = store.metadata
+
+    jobs = {}
+
+    for path, pathdata in walk_layout(config.layouts, metadata, changed=store.mark_changed):
         source = os.path.join(config.directories.source, path)
-        target = os.path.join(config.directories.target, path)
 
         for filename in os.listdir(source):
+            # Skip documents that are still being written, they are processed once they are complete
+            if os.path.abspath(os.path.join(source, filename)) in pending:
+                continue
+
             if filename.lower().endswith(".pdf"):
-                try:
-                    name = re.sub(r" \(\d+\)$", "", filename[:-4])
-                    parts = name.rsplit("_", 2)
+                add_job(jobs, config, path, pathdata, filename)
 
-                    title = parts[0]
-                    slug = slugify(title)
+    return run_jobs(config, store, jobs, index)
 
-                    source_filename = os.path.join(source, filename)
-                    target_filename_pdf = os.path.join(target, slug + ".pdf")
-                    target_filename_sdocx = os.path.join(target, slug + ".sdocx")
 
-                    logging.info("Processing: %s", source_filename)
+@stage("source")
+def handle_source_files(config: BaseConfig, store: MetadataStore, paths: Iterable[str], index=True) -> bool:
+    metadata = store.metadata
 
-                    try:
-                        modified = time.strptime(f"{parts[1]}-{parts[2]}", "%y%m%d-%H%M%S")
-                    except (IndexError, ValueError):
-                        logging.warning("Failed to parse date from filename, using file modification date")
-                        modified = time.localtime(os.path.getmtime(os.path.join(source, filename)))
+    jobs = {}
 
-                    converted = time.localtime()
+    # Only the reported files are converted, without scanning the whole source directory
+    for filepath in sorted(paths):
+        path, filename = os.path.split(os.path.relpath(filepath, config.directories.source))
 
-                    changes = True
+        if not filename.lower().endswith(".pdf") or not os.path.isfile(filepath):
+            continue
 
-                    if config.conversion.repaginate:
-                        repaginate_pdf(
-                            source_filename,
-                            target_filename_pdf,
-                            dpi=config.conversion.dpi,
-                            height=config.conversion.height,
-                        )
+        pathdata = find_layout(config.layouts, metadata, path, store.mark_changed)
 
-                        set_pdf_metadata(
-                            filename=target_filename_pdf,
-                            title=title,
-                            author=config.meta.author,
-                            language=config.meta.language,
-                            modified=modified,
-                            converted=converted,
-                        )
+        if pathdata is None:
+            logging.warning("Ignoring document outside of the layout: %s", filepath)
+            continue
 
-                    else:
-                        shutil.copy2(source_filename, target_filename_pdf)
+        add_job(jobs, config, path, pathdata, filename)
 
-                    sdocx = extract_sdocx(source_filename, target_filename_sdocx)
+    return run_jobs(config, store, jobs, index)
 
-                    os.remove(source_filename)
 
-                    pathdata.content[slug] = FileMetadata(
-                        slug=slug,
-                        name=title,
-                        modified=time.strftime("%Y-%m-%d %H:%M:%S", modified),
-                        converted=time.strftime("%Y-%m-%d %H:%M:%S", converted),
-                        extensions=["pdf", "sdocx"] if sdocx else ["pdf"],
-                    )
+def remove_missing(
+    config: BaseConfig,
+    store: MetadataStore,
+    path: str,
+    pathdata: DirectoryMetadata,
+    slugs: Iterable[str],
+) -> bool:
+    removed = []
 
-                    logging.info("Processed: %s", target_filename_pdf)
+    for slug in slugs:
+        meta = pathdata.content.get(slug)
 
-                except Exception as error:
-                    logging.exception("Failed to process document: %s", error)
+        if meta is None or not meta.type == "file":
+            continue
 
-    if not changes:
-        return
+        filename = os.path.join(config.directories.target, path, slug + ".pdf")
 
-    logging.info("Saving metadata...")
+        if not os.path.isfile(filename):
+            removed.append((slug, filename))
 
-    with open(metafile, "w", encoding="utf-8") as file:
-        file.write(metadata.model_dump_json(indent=2) + "\n")
+    for slug, filename in removed:
+        logging.info("Removing: %s", filename)
+        changes.deleted(filename)
+        del pathdata.content[slug]
+        store.mark_changed(path, slug)
 
-    if index:
-        render_index(config)
+        if (cache := page_cache(config, path, slug)) is not None:
+            shutil.rmtree(cache.directory, ignore_errors=True)
 
+    return bool(removed)
 
-def handle_target(config: BaseConfig, index=True):
+
+@stage("target")
+def handle_target(config: BaseConfig, store: MetadataStore, index=True) -> bool:
     ensure_structure(config.layouts, config.directories.source)
     ensure_structure(config.layouts, config.directories.target)
 
-    metafile = os.path.join(config.directories.target, "metadata.json")
+    metadata = store.metadata
 
-    if os.path.isfile(metafile):
-        with open(metafile, encoding="utf-8") as file:
-            metadata = BaseMetadata.model_validate_json(file.read())
-    else:
-        metadata = BaseMetadata(root={})
+    changed = False
 
-    changes = False
+    for path, pathdata in walk_layout(config.layouts, metadata, changed=store.mark_changed):
+        changed |= remove_missing(config, store, path, pathdata, list(pathdata.content))
 
-    for path, pathdata in walk_layout(config.layouts, metadata):
-        removed = []
+    if not changed:
+        return False
 
-        for slug, meta in pathdata.content.items():
-            if not meta.type == "file":
-                continue
+    if index:
+        render_index(config, store)
 
-            filename = os.path.join(config.directories.target, path, slug + ".pdf")
+    return True
 
-            if not os.path.isfile(filename):
-                removed.append((slug, filename))
 
-        for slug, filename in removed:
-            logging.info("Removing: %s", filename)
-            del pathdata.content[slug]
-            changes = True
+@stage("target")
+def handle_target_paths(config: BaseConfig, store: MetadataStore, paths: Iterable[str], index=True) -> bool:
+    metadata = store.metadata
 
-    if not changes:
-        return
+    changed = False
+
+    def remove_directory(path: str, pathdata: DirectoryMetadata) -> bool:
+        # Documents of all nested directories were removed together with the directory
+        removed = remove_missing(config, store, path, pathdata, list(pathdata.content))
+
+        for slug, node in pathdata.content.items():
+            if node.type == "directory":
+                removed |= remove_directory(os.path.join(path, slug), node)
+
+        return removed
+
+    for filepath in sorted(paths):
+        relative = os.path.relpath(filepath, config.directories.target)
+
+        if relative.lower().endswith(".pdf"):
+            path, filename = os.path.split(relative)
+
+            if (pathdata := find_layout(config.layouts, metadata, path, store.mark_changed)) is not None:
+                changed |= remove_missing(config, store, path, pathdata, [filename[:-4]])
 
-    logging.info("Saving metadata...")
+        else:
+            # Removed layout directories are created again
+            ensure_structure(config.layouts, config.directories.target)
 
-    with open(metafile, "w", encoding="utf-8") as file:
-        file.write(metadata.model_dump_json(indent=2) + "\n")
+            if (pathdata := find_layout(config.layouts, metadata, relative, store.mark_changed)) is not None:
+                changed |= remove_directory(relative, pathdata)
+
+    if not changed:
+        return False
 
     if index:
-        render_index(config)
+        render_index(config, store)
 
+    return True
 
-def update_metadata(config: BaseConfig, index=True):
-    metafile = os.path.join(config.directories.target, "metadata.json")
 
-    if os.path.isfile(metafile):
-        with open(metafile, encoding="utf-8") as file:
-            metadata = BaseMetadata.model_validate_json(file.read())
-    else:
-        metadata = BaseMetadata(root={})
+@stage("metadata")
+def update_metadata(config: BaseConfig, store: MetadataStore, index=True):
+    metadata = store.metadata
 
-    for _ in walk_layout(config.layouts, metadata):
+    for _ in walk_layout(config.layouts, metadata, changed=store.mark_changed):
         # We don't need to do anything here, just iterate through the layout
-        # Walking the layout already updates the metadata
+        # Walking the layout already updates the metadata and marks the changed directories
         pass
 
-    logging.info("Saving metadata...")
+    if index:
+        render_index(config, store)
 
-    with open(metafile, "w", encoding="utf-8") as file:
-        file.write(metadata.model_dump_json(indent=2) + "\n")
 
-    if index:
-        render_index(config)
+def digest_tree(tree: dict, path: str = "", digests: dict[str, str] | None = None) -> dict[str, str]:
+    if digests is None:
+        digests = {}
 
+    digest = hashlib.sha256()
 
-def sort_tree[T: dict](tree: T) -> T:
-    if not isinstance(tree, dict):
-        return tree
+    for slug, node in tree.items():
+        digest.update(slug.encode("utf-8"))
+        digest.update(node.model_dump_json(exclude={"content"}).encode("utf-8"))
 
-    # Sort directories first, then files, both alphabetically
-    items = sorted(
-        tree.items(),
-        key=lambda item: (0 if item[1].type == "directory" else 1, item[1].name.lower()),
-    )
+        if node.type == "directory":
+            node_path = os.path.join(path, slug)
+            digest_tree(node.content, node_path, digests)
+            digest.update(digests[node_path].encode("utf-8"))
 
-    modified = {}
+    digests[path] = digest.hexdigest()
 
-    for key, node in items:
-        if getattr(node, "type", None) == "directory":
-            node.content = sort_tree(node.content)
-        modified[key] = node
+    return digests
 
-    return modified
 
+def digest_context(*parts) -> str:
+    def default(value):
+        return value.model_dump()
 
-def render_index(config: BaseConfig):
-    metafile = os.path.join(config.directories.target, "metadata.json")
+    serialized = json.dumps(parts, sort_keys=True, default=default)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def load_index_digests(config: BaseConfig) -> dict[str, str]:
+    digestfile = os.path.join(config.directories.target, ".cache", "indexes.json")
+
+    try:
+        with open(digestfile, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-    if not os.path.isfile(metafile):
-        return
 
-    logging.info("Rendering root index: index.html")
+def save_index_digests(config: BaseConfig, digests: dict[str, str]):
+    digestfile = os.path.join(config.directories.target, ".cache", "indexes.json")
+    os.makedirs(os.path.dirname(digestfile), exist_ok=True)
 
-    with open(metafile, encoding="utf-8") as file:
-        metadata = BaseMetadata.model_validate_json(file.read())
+    with open(digestfile, "w", encoding="utf-8") as file:
+        json.dump(digests, file, indent=2, sort_keys=True)
 
-    environment = prepare_environment()
-    template = environment.get_template("root.html")
+
+@stage("index")
+def render_index(config: BaseConfig, store: MetadataStore):
+    metadata = store.metadata
+
+    # Digests of the previous render and of the tree are shared with subindexes, so they are computed once
+    previous = load_index_digests(config)
+    subtrees = digest_tree(metadata.content)
+    templates = template_digest()
     output = os.path.join(config.directories.target, "index.html")
 
-    with open(output, "w", encoding="utf-8") as file:
-        file.write(template.render(tree=sort_tree(metadata.content), meta=config.meta, index=config.index))
+    assets = static_assets(config)
+    digest = digest_context(subtrees[""], templates, config.meta, config.index, config.static, assets)
 
-    render_subindexes(config)
+    if previous.get("index.html") != digest or not os.path.isfile(output):
+        logging.info("Rendering root index: index.html")
 
-    copy_assets(config)
+        environment = prepare_environment(os.path.join(config.directories.target, ".cache", "jinja"))
+        template = environment.get_template("root.html")
 
+        content = template.render(
+            tree=metadata.content,
+            meta=config.meta,
+            index=config.index,
+            assets=assets,
+        )
+        write_page(output, content, config.static.minify, config.static.precompress)
 
-def render_subindexes(config: BaseConfig):
-    metafile = os.path.join(config.directories.target, "metadata.json")
+    digests = {"index.html": digest}
+
+    render_subindexes(config, store, digests, assets, previous, subtrees, templates)
+
+    save_index_digests(config, digests)
+
+    copy_assets(config, assets)
 
-    if not os.path.isfile(metafile):
-        return
 
-    with open(metafile, encoding="utf-8") as file:
-        metadata = BaseMetadata.model_validate_json(file.read())
+@stage("subindexes")
+def render_subindexes(
+    config: BaseConfig,
+    store: MetadataStore,
+    digests: dict[str, str] | None = None,
+    assets: dict[str, str] | None = None,
+    previous: dict[str, str] | None = None,
+    subtrees: dict[str, str] | None = None,
+    templates: str | None = None,
+):
+    metadata = store.metadata
 
-    environment = prepare_environment()
-    template = environment.get_template("directory.html")
+    # Indexes are only rendered again when their content, context or templates changed
+    current = {} if digests is None else digests
+
+    # The root index passes its digests and assets, so they are only computed here for subindexes alone
+    if previous is None:
+        previous = load_index_digests(config)
+
+    if subtrees is None:
+        subtrees = digest_tree(metadata.content)
+
+    if templates is None:
+        templates = template_digest()
+
+    if assets is None:
+        assets = static_assets(config)
 
     def generate_subindexes(tree: dict, path: str = "", depth: int = 0, trail: list | None = None):
         if trail is None:
@@ -312,17 +682,39 @@ def generate_subindexes(tree: dict, path: str = "", depth: int = 0, trail: list
                 {"name": node.name, "url": index_url},
             ]
 
-            logging.info(
-                "Rendering subindex: %s (depth=%d, remaining=%d)",
-                os.path.relpath(index_path, config.directories.target),
+            index_key = os.path.relpath(index_path, config.directories.target)
+
+            digest = digest_context(
+                subtrees[node_path],
+                templates,
+                config.meta,
+                config.index,
+                config.static,
+                assets,
+                node.name,
+                node.description,
                 current_depth,
-                remaining_depth,
+                breadcrumbs,
             )
 
-            with open(index_path, "w", encoding="utf-8") as file:
-                file.write(
+            current[index_key] = digest
+
+            if previous.get(index_key) != digest or not os.path.isfile(index_path):
+                logging.info(
+                    "Rendering subindex: %s (depth=%d, remaining=%d)",
+                    index_key,
+                    current_depth,
+                    remaining_depth,
+                )
+
+                # Templates are only loaded once something has to be rendered, as the environment is cached
+                environment = prepare_environment(os.path.join(config.directories.target, ".cache", "jinja"))
+                template = environment.get_template("directory.html")
+
+                write_page(
+                    index_path,
                     template.render(
-                        tree=sort_tree(node.content),
+                        tree=node.content,
                         name=node.name,
                         description=node.description,
                         meta=config.meta,
@@ -331,7 +723,10 @@ def generate_subindexes(tree: dict, path: str = "", depth: int = 0, trail: list
                         remaining_depth=remaining_depth,
                         canonical_url=index_url,
                         breadcrumbs=breadcrumbs,
-                    )
+                        assets=assets,
+                    ),
+                    config.static.minify,
+                    config.static.precompress,
                 )
 
             if node.content:
@@ -341,6 +736,9 @@ def generate_subindexes(tree: dict, path: str = "", depth: int = 0, trail: list
 
     generate_subindexes(metadata.content)
 
+    if digests is None:
+        save_index_digests(config, {**previous, **current})
+
     if config.index.depth == -1:
         return
 
@@ -353,58 +751,65 @@ def generate_subindexes(tree: dict, path: str = "", depth: int = 0, trail: list
             if os.path.isfile(os.path.join(dirpath, "index.html")):
                 logging.info("Deleting subindex: %s", os.path.join(rel, "index.html"))
                 os.remove(os.path.join(dirpath, "index.html"))
+                changes.deleted(os.path.join(dirpath, "index.html"))
+                remove_compressed(os.path.join(dirpath, "index.html"))
 
 
-def copy_assets(config: BaseConfig):
-    dirname = os.path.join(os.path.dirname(__file__))
-    assets = os.path.join(dirname, "assets")
-    target = os.path.join(dirname, config.directories.target)
+def static_assets(config: BaseConfig) -> dict[str, str]:
+    if not (config.static.minify or config.static.fingerprint or config.static.precompress):
+        return {}
 
-    # Copy all assets to target directory
-    shutil.copytree(assets, target, dirs_exist_ok=True)
+    assets = os.path.join(os.path.dirname(__file__), "assets")
+    staging = os.path.join(config.directories.target, ".cache", "static")
 
-    # Keep data and autogenerated files
-    keep = {"index.html", "metadata.json"}
+    return build_assets(assets, staging, **config.static.model_dump())
 
-    # Add all top-level directories from config
-    for layout in config.layouts:
-        if hasattr(layout, "name"):
-            keep.add(slugify(layout.name))
 
-    def cleanup(current: str = "", toplevel: bool = False):
-        for name in os.listdir(os.path.join(target, current)):
-            if toplevel and name in keep:
-                continue
+@stage("assets")
+def copy_assets(config: BaseConfig, built: dict[str, str]):
+    dirname = os.path.join(os.path.dirname(__file__))
+    assets = os.path.join(dirname, "assets")
+    target = os.path.join(dirname, config.directories.target)
 
-            if os.path.isdir(os.path.join(target, current, name)):
-                cleanup(os.path.join(current, name), toplevel=False)
-                continue
+    # Optimized assets are built into a staging directory and installed from there
+    if built:
+        assets = os.path.join(target, ".cache", "static")
 
-            if os.path.isfile(os.path.join(assets, current, name)):
-                continue
+    manifest = os.path.join(target, ".cache", "assets.json")
+
+    # Only changed assets are copied, and only assets from the previous sync are deleted
+    sync_directory(assets, target, manifest, config.directories.cleanup)
 
-            logging.info("Deleting asset: %s", os.path.join(current, name))
-            os.remove(os.path.join(target, current, name))
 
-    # Cleanup excessive files in target
-    if config.directories.cleanup:
-        cleanup(toplevel=True)
+def hook_manifest(config: BaseConfig) -> str:
+    return os.path.join(config.directories.target, ".cache", "hooks", "manifest.json")
 
 
+@stage("pre_hook")
 def run_pre_hook(config: BaseConfig):
     if config.hooks.pre:
         logging.info("Running pre-hook: %s", config.hooks.pre)
-        os.system(config.hooks.pre)
+        run_hook(config.hooks.pre, config.hooks.timeout)
+
 
+@stage("post_hook")
+def run_post_hook(config: BaseConfig, runner: HookRunner | None = None):
+    # Changes are collected even without a hook, so they don't accumulate while watching
+    changed = changes.collect()
 
-def run_post_hook(config: BaseConfig):
-    if config.hooks.post:
-        logging.info("Running post-hook: %s", config.hooks.post)
-        os.system(config.hooks.post)
+    if not config.hooks.post:
+        return
 
+    logging.info("Running post-hook: %s", config.hooks.post)
 
-@click.group()
-def cli():
+    if runner is not None:
+        # Watching only starts the hook, so a slow hook doesn't delay processing of new changes
+        runner.submit(config.hooks.post, config.hooks.timeout, changed)
+    else:
+        run_hook(config.hooks.post, config.hooks.timeout, write_manifest(hook_manifest(config), changed))
+
+
+def setup_logging():
     logging.basicConfig(
         stream=sys.stderr,
         level=logging.INFO,
@@ -413,6 +818,11 @@ def cli():
     )
 
 
+@click.group()
+def cli():
+    setup_logging()
+
+
 @cli.command()
 def schema():
     """Print the JSON schema for the config."""
@@ -423,41 +833,103 @@ def schema():
 
 @cli.command()
 @click.option("--config", default="config.yaml", help="Path to config file.")
-def process(config: str):
+@click.option("--output", default=None, help="Path to the exported file.")
+def export(config: str, output: str | None):
+    """Export the metadata into a JSON file."""
+
+    config = load_config(config)
+    output = output or os.path.join(config.directories.target, "metadata.json")
+
+    metadata_store(config).export(output)
+
+
+@cli.command()
+@click.option("--config", default="config.yaml", help="Path to config file.")
+@click.option("--profile", is_flag=True, help="Log time and memory usage of each stage.")
+def process(config: str, profile: bool):
     """Process files once and exist."""
 
-    config = parse_yaml_file_as(BaseConfig, config)
+    config = load_config(config)
+    recorder.configure(profile, config.metrics.jsonl, config.metrics.prometheus)
+
+    store = metadata_store(config)
+    changes.configure(config.directories.target)
 
     run_pre_hook(config)
-    handle_source(config, False)
-    handle_target(config, False)
-    update_metadata(config, False)
-    render_index(config)
+    handle_source(config, store, False)
+    handle_target(config, store, False)
+    update_metadata(config, store, False)
+    render_index(config, store)
+    store.flush()
     run_post_hook(config)
+    recorder.flush()
 
 
 @cli.command()
 @click.option("--config", default="config.yaml", help="Path to config file.")
-def watch(config: str):
+@click.option("--profile", is_flag=True, help="Log time and memory usage of each stage.")
+def watch(config: str, profile: bool):
     """Process files and watch for changes."""
 
     configfile = os.path.abspath(config)
 
-    config = parse_yaml_file_as(BaseConfig, configfile)
+    config = load_config(configfile)
+    recorder.configure(profile, config.metrics.jsonl, config.metrics.prometheus)
+
+    # The metadata stays loaded while watching, so events don't need to parse it again
+    store = metadata_store(config)
+    changes.configure(config.directories.target)
+
+    runner = HookRunner(hook_manifest(config))
+    runner.start()
 
     run_pre_hook(config)
-    handle_source(config, False)
-    handle_target(config, False)
-    update_metadata(config, False)
-    render_index(config)
-    run_post_hook(config)
+    handle_source(config, store, False)
+    handle_target(config, store, False)
+    update_metadata(config, store, False)
+    render_index(config, store)
+    store.flush()
+    run_post_hook(config, runner)
+    recorder.flush()
 
     logging.info("Watching for file changes...")
 
+    from watchdog.observers import Observer
+
     observer = Observer()
-    observer.schedule(SourceHandler(configfile), config.directories.source, recursive=True)
-    observer.schedule(TargetHandler(configfile), config.directories.target, recursive=True)
-    observer.schedule(ConfigHandler(configfile), os.path.dirname(configfile), recursive=False)
+
+    def schedule_watches(config: BaseConfig):
+        target = os.path.abspath(config.directories.target)
+
+        observer.unschedule_all()
+        observer.schedule(SourceHandler(tracker), config.directories.source, recursive=True)
+        observer.schedule(TargetHandler(scheduler, target), target, recursive=True)
+        observer.schedule(ConfigHandler(scheduler, configfile), os.path.dirname(configfile), recursive=False)
+
+    def process_changes(batch: dict[str, set[str]]):
+        nonlocal config, store
+
+        previous = config
+        config, store = process_batch(configfile, previous, store, runner, batch, tracker)
+
+        # Reloaded configs may move the directories, so the watches follow them
+        if (config.directories.source, config.directories.target) != (
+            previous.directories.source,
+            previous.directories.target,
+        ):
+            schedule_watches(config)
+
+    scheduler = BatchScheduler(process_changes, config.watch.debounce)
+    scheduler.start()
+
+    tracker = ReadinessTracker(functools.partial(scheduler.submit, "source"))
+    tracker.start()
+
+    # Full scans of both directories can be requested explicitly with SIGHUP
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: scheduler.submit("reconcile", ""))
+
+    schedule_watches(config)
     observer.start()
 
     try:
@@ -466,6 +938,9 @@ def watch(config: str):
     finally:
         observer.stop()
         observer.join()
+        tracker.stop()
+        scheduler.stop()
+        runner.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import unittest
+
+from PIL import Image, ImageDraw
+
+from utils.encoding import (
+    MAX_ERROR,
+    decode_palette,
+    encode_image,
+    encode_palette,
+    is_two_tone,
+    reconstruction_error,
+    threshold_bilevel,
+)
+
+
+def draw_page(color: tuple[int, int, int]) -> Image:
+    """Draw a page of anti-aliased strokes in a single colour."""
+
+    image = Image.new("RGB", (1600, 2000), "white")
+    draw = ImageDraw.Draw(image)
+
+    for y in range(100, 1900, 60):
+        draw.line([(100, y), (1500, y + 20)], fill=color, width=12)
+
+    # Downsampling gives the strokes anti-aliased edges, like rendered pages have
+    return image.resize((800, 1000), Image.Resampling.LANCZOS)
+
+
+class AutoEncodingTest(unittest.TestCase):
+    def test_black_page_is_two_tone(self):
+        page = draw_page((0, 0, 0))
+
+        self.assertTrue(is_two_tone(page))
+        self.assertLessEqual(reconstruction_error(page, threshold_bilevel(page)), MAX_ERROR)
+
+    def test_grey_page_is_not_bilevel(self):
+        for color in ((128, 128, 128), (90, 90, 90), (200, 200, 200)):
+            with self.subTest(color=color):
+                page = draw_page(color)
+
+                self.assertFalse(is_two_tone(page))
+                self.assertNotEqual(encode_image(page, "auto").encoding, "bilevel")
+
+    def test_palette_round_trip(self):
+        page = draw_page((0, 0, 160))
+        encoded = encode_palette(page, colors=16)
+
+        self.assertEqual(decode_palette(encoded).size, page.size)
+        self.assertLessEqual(reconstruction_error(page, decode_palette(encoded)), MAX_ERROR)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .document import SourceDocument
+
+
+class ConversionCache:
+    """Persistent cache of converted documents keyed by source content and conversion parameters."""
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, document: SourceDocument, **parameters) -> str:
+        """Compute the cache key for a source file and conversion parameters."""
+
+        digest = document.digest()
+        digest.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def load(self, key: str, pdf_filename: str, sdocx_filename: str) -> dict | None:
+        """Restore a cached conversion and return its stored information."""
+
+        entry = os.path.join(self.directory, key)
+        infofile = os.path.join(entry, "entry.json")
+
+        try:
+            with open(infofile, encoding="utf-8") as file:
+                info = json.load(file)
+
+            shutil.copyfile(os.path.join(entry, "document.pdf"), pdf_filename)
+
+            if "sdocx" in info["extensions"]:
+                shutil.copyfile(os.path.join(entry, "document.sdocx"), sdocx_filename)
+
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # Mark the entry as recently used
+        os.utime(infofile)
+
+        return info
+
+    def store(self, key: str, pdf_filename: str, sdocx_filename: str | None, info: dict):
+        """Store a converted document in the cache."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Entries are prepared in a temporary directory and moved in place so readers never see partial entries
+        staging = tempfile.mkdtemp(prefix=".", dir=self.directory)
+
+        try:
+            shutil.copyfile(pdf_filename, os.path.join(staging, "document.pdf"))
+
+            if sdocx_filename is not None:
+                shutil.copyfile(sdocx_filename, os.path.join(staging, "document.sdocx"))
+
+            with open(os.path.join(staging, "entry.json"), "w", encoding="utf-8") as file:
+                json.dump(info, file)
+
+            entry = os.path.join(self.directory, key)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(staging, entry)
+
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size limit."""
+
+        if not os.path.isdir(self.directory):
+            return
+
+        entries = []
+        total = 0
+
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            infofile = os.path.join(entry, "entry.json")
+
+            if name.startswith(".") or not os.path.isfile(infofile):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+            entries.append((os.path.getmtime(infofile), size, name))
+            total += size
+
+        entries.sort()
+
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+
+            logging.info("Evicting cached conversion: %s", name)
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+
+
+class PageCache:
+    """Persistent repagination progress of a single document, used to skip its unchanged leading pages."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self) -> dict:
+        """Load the state of the previous run and invalidate it until the next save."""
+
+        indexfile = os.path.join(self.directory, "index.json")
+
+        try:
+            with open(indexfile, encoding="utf-8") as file:
+                state = json.load(file)
+
+            os.remove(indexfile)
+
+        except (OSError, ValueError):
+            state = {}
+
+        return {
+            "fingerprints": state.get("fingerprints", []),
+            "checkpoints": state.get("checkpoints", []),
+            "outputs": state.get("outputs", []),
+        }
+
+    def save(self, state: dict):
+        """Save the state of the current run and remove outputs that are no longer used."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        for name in os.listdir(self.directory):
+            if name.startswith("output-") and int(name[7:].split(".")[0]) >= len(state["outputs"]):
+                os.remove(os.path.join(self.directory, name))
+
+        indexfile = os.path.join(self.directory, "index.json")
+
+        with open(indexfile + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(state, file)
+
+        os.replace(indexfile + ".tmp", indexfile)
+
+    def write_output(self, index: int, data: bytes):
+        """Store an encoded output page."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, f"output-{index}.bin"), "wb") as file:
+            file.write(data)
+
+    def read_output(self, index: int) -> bytes:
+        """Read an encoded output page."""
+
+        with open(os.path.join(self.directory, f"output-{index}.bin"), "rb") as file:
+            return file.read()
+
+
+def evict_pages(directory: str, max_size: int):
+    """Remove repagination progress of the least recently converted documents until it fits its size limit."""
+
+    entries = []
+    total = 0
+
+    for dirpath, _, filenames in os.walk(directory):
+        if not any(name == "index.json" or name.startswith("output-") for name in filenames):
+            continue
+
+        size = sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+        indexfile = os.path.join(dirpath, "index.json")
+
+        # Progress without an index can't be reused, so it is removed first
+        used = os.path.getmtime(indexfile) if "index.json" in filenames else 0
+        entries.append((used, size, dirpath))
+        total += size
+
+    entries.sort()
+
+    for _, size, dirpath in entries:
+        if total <= max_size:
+            break
+
+        logging.info("Evicting cached pages: %s", os.path.relpath(dirpath, directory))
+        shutil.rmtree(dirpath, ignore_errors=True)
+        total -= size
@@ -0,0 +1,48 @@
+import os
+
+
+class ChangeLog:
+    """Track files in the target directory that were written or deleted since the last collection."""
+
+    def __init__(self):
+        self.root: str | None = None
+        self.changes: dict[str, str] = {}
+
+    def configure(self, root: str):
+        """Start tracking changes of files in a directory."""
+
+        self.root = os.path.abspath(root)
+
+    def record(self, path: str, change: str):
+        """Record a change of a file, replacing earlier changes of the same file."""
+
+        if self.root is None:
+            return
+
+        path = os.path.relpath(os.path.abspath(path), self.root)
+
+        # Files outside the tracked directory and caches inside it are not published, so they are not reported
+        if path.split(os.sep)[0] in ("..", ".cache"):
+            return
+
+        self.changes.pop(path, None)
+        self.changes[path] = change
+
+    def written(self, path: str):
+        """Record that a file was created or replaced."""
+
+        self.record(path, "written")
+
+    def deleted(self, path: str):
+        """Record that a file was deleted."""
+
+        self.record(path, "deleted")
+
+    def collect(self) -> dict[str, str]:
+        """Remove and return all changes that were not reported yet."""
+
+        changes, self.changes = self.changes, {}
+        return changes
+
+
+changes = ChangeLog()
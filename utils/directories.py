@@ -1,8 +1,16 @@
+import contextlib
+import hashlib
+import json
+import logging
 import os
+import shutil
 import time
+from collections.abc import Callable
 
+from utils.changes import changes
 from utils.models import BaseMetadata, DirectoryMetadata, LayoutConfig
 from utils.text import slugify
+from utils.tree import insert_node
 
 
 def wait_ready(path: str):
@@ -22,6 +30,84 @@ def wait_ready(path: str):
         time.sleep(1)
 
 
+def update_file(path: str, content: str) -> bool:
+    """Write a text file unless it already has the same content."""
+
+    data = content.encode("utf-8")
+
+    try:
+        with open(path, "rb") as file:
+            if file.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    with open(path, "wb") as file:
+        file.write(data)
+
+    return True
+
+
+def file_hash(path: str) -> str:
+    """Compute the SHA-256 hash of a file."""
+
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def sync_directory(source: str, target: str, manifest: str, cleanup: bool = True):
+    """Copy changed files to the target and remove files that were installed before but no longer exist."""
+
+    try:
+        with open(manifest, encoding="utf-8") as file:
+            previous = json.load(file)
+    except (OSError, ValueError):
+        previous = {}
+
+    current = {}
+
+    for root, _, files in os.walk(source):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), source)
+            source_path = os.path.join(source, path)
+            target_path = os.path.join(target, path)
+
+            stat = os.stat(source_path)
+            entry = previous.get(path)
+
+            # Hashes are only computed again for source files that changed since the last sync
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                digest = entry["hash"]
+            else:
+                digest = file_hash(source_path)
+
+            current[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest}
+
+            try:
+                installed = os.stat(target_path).st_size == stat.st_size
+            except FileNotFoundError:
+                installed = False
+
+            # Files from an unknown previous sync are compared by content, so they are not rewritten either
+            if installed and (entry["hash"] == digest if entry else file_hash(target_path) == digest):
+                continue
+
+            logging.info("Copying asset: %s", path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            shutil.copy2(source_path, target_path)
+            changes.written(target_path)
+
+    if cleanup:
+        for path in previous.keys() - current.keys():
+            logging.info("Deleting asset: %s", path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(target, path))
+                changes.deleted(os.path.join(target, path))
+
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    update_file(manifest, json.dumps(current, indent=2, sort_keys=True))
+
+
 def ensure_structure(layouts: list[LayoutConfig], base: str):
     """Ensure directory structure based on layout configuration."""
 
@@ -35,25 +121,78 @@ def ensure_structure(layouts: list[LayoutConfig], base: str):
             ensure_structure(layout.content, dir_path)
 
 
-def walk_layout(layouts: list[LayoutConfig], metadata: BaseMetadata | DirectoryMetadata, base: str = ""):
+def layout_metadata(
+    layout: LayoutConfig,
+    metadata: BaseMetadata | DirectoryMetadata,
+    base: str = "",
+    changed: Callable[[str, str], None] | None = None,
+) -> DirectoryMetadata:
+    """Get the metadata of a layout directory, updating it from the layout configuration."""
+
+    dir_name = slugify(layout.name)
+
+    if dir_name not in metadata.content:
+        node = DirectoryMetadata(slug=dir_name, name=layout.name, description=layout.description)
+        insert_node(metadata.content, dir_name, node)
+
+    else:
+        node = metadata.content[dir_name]
+
+        if (node.slug, node.name, node.description) == (dir_name, layout.name, layout.description):
+            return node
+
+        node.slug = dir_name
+        node.description = layout.description
+
+        # Renamed directories may have to move to keep the content in order
+        if node.name != layout.name:
+            del metadata.content[dir_name]
+            node.name = layout.name
+            insert_node(metadata.content, dir_name, node)
+
+    # Only directories that were added or updated have to be saved
+    if changed is not None:
+        changed(base, dir_name)
+
+    return node
+
+
+def walk_layout(
+    layouts: list[LayoutConfig],
+    metadata: BaseMetadata | DirectoryMetadata,
+    base: str = "",
+    changed: Callable[[str, str], None] | None = None,
+):
     """Walk through the layout structure and yield paths and metadata."""
 
     for layout in layouts:
-        dir_name = slugify(layout.name)
-        dir_path = os.path.join(base, dir_name)
-
-        if dir_name not in metadata.content:
-            metadata.content[dir_name] = DirectoryMetadata(
-                slug=dir_name,
-                name=layout.name,
-                description=layout.description,
-            )
-        else:
-            metadata.content[dir_name].slug = dir_name
-            metadata.content[dir_name].name = layout.name
-            metadata.content[dir_name].description = layout.description
+        dir_path = os.path.join(base, slugify(layout.name))
+        pathdata = layout_metadata(layout, metadata, base, changed)
 
-        yield dir_path, metadata.content[dir_name]
+        yield dir_path, pathdata
 
         if layout.content:
-            yield from walk_layout(layout.content, metadata.content[dir_name], dir_path)
+            yield from walk_layout(layout.content, pathdata, dir_path, changed)
+
+
+def find_layout(
+    layouts: list[LayoutConfig],
+    metadata: BaseMetadata | DirectoryMetadata,
+    path: str,
+    changed: Callable[[str, str], None] | None = None,
+) -> DirectoryMetadata | None:
+    """Find the metadata of the layout directory at a relative path, without walking the whole layout."""
+
+    pathdata = None
+    base = ""
+
+    for part in path.split(os.sep):
+        layout = next((layout for layout in layouts if slugify(layout.name) == part), None)
+
+        if layout is None:
+            return None
+
+        pathdata = layout_metadata(layout, metadata, base, changed)
+        layouts, metadata, base = layout.content, pathdata, os.path.join(base, part)
+
+    return pathdata
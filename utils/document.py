@@ -0,0 +1,99 @@
+import ctypes
+import hashlib
+import mmap
+
+import pikepdf
+import pypdfium2
+import pypdfium2.raw as pdfium_c
+from PIL import Image
+
+
+class SourceDocument:
+    """A source PDF file that is opened once and shared by all conversion stages."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+
+        with open(filename, "rb") as file:
+            # Copy on write mapping is never written, but PDFium requires a writable buffer to avoid a copy
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        self._pdf = None
+        self._pdfium = None
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the parsed documents and the file mapping."""
+
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+
+        if self._pdfium is not None:
+            self._pdfium.close()
+            self._pdfium = None
+
+        # The mapping can only be closed once nothing exports it anymore
+        self._buffer = None
+        self.data.close()
+
+    @property
+    def pdf(self) -> pikepdf.Pdf:
+        """Return the document structure, parsing it on the first access."""
+
+        if self._pdf is None:
+            # pikepdf can't read from the shared mapping without copying it or reading through Python calls,
+            # so it maps the file itself, which still shares the same pages of the system file cache
+            self._pdf = pikepdf.open(self.filename, access_mode=pikepdf.AccessMode.mmap)
+
+        return self._pdf
+
+    @property
+    def catalog(self) -> pikepdf.Dictionary:
+        """Return the document catalog."""
+
+        return self.pdf.Root
+
+    @property
+    def pdfium(self) -> pypdfium2.PdfDocument:
+        """Return the document for rendering, loading it on the first access."""
+
+        if self._pdfium is None:
+            # The document is loaded here, so the buffer is owned by this object and not kept alive by PDFium
+            self._buffer = (ctypes.c_char * len(self.data)).from_buffer(self.data)
+            document = pdfium_c.FPDF_LoadMemDocument64(self._buffer, len(self._buffer), None)
+
+            if not document:
+                self._buffer = None
+                raise pypdfium2.PdfiumError(f"Failed to load document (error {pdfium_c.FPDF_GetLastError()})")
+
+            self._pdfium = pypdfium2.PdfDocument(document)
+
+        return self._pdfium
+
+    def digest(self):
+        """Compute a SHA-256 digest of the file content."""
+
+        return hashlib.sha256(self.data)
+
+    def page_sizes(self) -> list[tuple[float, float]]:
+        """Return sizes of all pages in points."""
+
+        return [self.pdfium.get_page_size(index) for index in range(len(self.pdfium))]
+
+    def render_page(self, index: int, dpi: int | float = 300) -> Image:
+        """Render a single page as an RGB image."""
+
+        page = self.pdfium[index]
+
+        try:
+            bitmap = page.render(scale=dpi / 72, prefer_bgrx=True)
+            return bitmap.to_pil().convert("RGB")
+        finally:
+            page.close()
@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import io
+import math
+import zlib
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+# Anti-aliased edges of black strokes are mid-tones, but only for a small share of the written pixels
+MIDTONE_SHARE = 0.35
+
+# Lossy candidates are rejected when written pixels change by more than this on average
+MAX_ERROR = 32
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    filter: str = "/DCTDecode"
+    colorspace: str = "/DeviceRGB"
+    bits: int = 8
+    palette: str | None = None
+    encoding: str = "jpeg"
+
+
+def encode_jpeg(image: Image, quality: int = 75) -> EncodedImage:
+    """Encode an image as a JPEG."""
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+
+    return EncodedImage(buffer.getvalue(), image.width, image.height)
+
+
+def encode_jpeg2000(image: Image, quality: int = 75) -> EncodedImage:
+    """Encode an image as a JPEG 2000, losslessly when the quality is 100."""
+
+    # The quality is mapped to the target PSNR, so the same value gives a comparable result as JPEG
+    options = {} if quality >= 100 else {"quality_mode": "dB", "quality_layers": [20 + quality / 4]}
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG2000", **options)
+
+    return EncodedImage(buffer.getvalue(), image.width, image.height, "/JPXDecode", encoding="jpeg2000")
+
+
+def encode_palette(image: Image, colors: int = 16) -> EncodedImage:
+    """Encode an image with an adaptive palette, compressed with Flate."""
+
+    quantized = image.quantize(colors=colors, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+    palette = bytes(quantized.getpalette()[: 3 * colors])
+
+    # Indices are packed as tightly as the number of colours allows
+    count = len(palette) // 3
+    bits = next(bits for bits in (1, 2, 4, 8) if count <= 2**bits)
+    data = quantized.tobytes("raw", f"P;{bits}" if bits < 8 else "P")
+
+    return EncodedImage(
+        zlib.compress(data),
+        image.width,
+        image.height,
+        "/FlateDecode",
+        "/Indexed",
+        bits,
+        palette.hex(),
+        "palette",
+    )
+
+
+def encode_bilevel(image: Image) -> EncodedImage:
+    """Encode an image as black and white with CCITT Group 4."""
+
+    # JBIG2 compresses better, but neither Pillow nor pikepdf ships an encoder for it
+
+    bilevel = threshold_bilevel(image)
+
+    # Pillow only exposes the Group 4 encoder through TIFF, so the data is taken from a single strip
+    buffer = io.BytesIO()
+    strip_size = math.ceil(image.width / 8) * image.height
+    bilevel.save(buffer, format="TIFF", compression="group4", strip_size=strip_size)
+
+    with Image.open(buffer) as tiff:
+        offset = tiff.tag_v2[273][0]
+        length = tiff.tag_v2[279][0]
+
+    data = buffer.getvalue()[offset : offset + length]
+
+    return EncodedImage(
+        data, image.width, image.height, "/CCITTFaxDecode", "/DeviceGray", 1, encoding="bilevel"
+    )
+
+
+def threshold_bilevel(image: Image) -> Image:
+    """Convert an image to black and white, as it is stored by the bilevel encoding."""
+
+    return image.convert("L").convert("1", dither=Image.Dither.NONE)
+
+
+def decode_palette(encoded: EncodedImage) -> Image:
+    """Decode an image encoded with an adaptive palette."""
+
+    mode = f"P;{encoded.bits}" if encoded.bits < 8 else "P"
+    image = Image.frombytes("P", (encoded.width, encoded.height), zlib.decompress(encoded.data), "raw", mode)
+    image.putpalette(bytes.fromhex(encoded.palette))
+
+    return image
+
+
+def is_monochrome(image: Image, tolerance: int = 32) -> bool:
+    """Check whether an image only contains shades of grey."""
+
+    pixels = np.asarray(image.convert("RGB"))
+    spread = pixels.max(axis=2) - pixels.min(axis=2)
+
+    return int(spread.max()) <= tolerance
+
+
+def is_two_tone(image: Image, share: float = MIDTONE_SHARE) -> bool:
+    """Check whether an image only contains black and white, apart from anti-aliased edges."""
+
+    if not is_monochrome(image):
+        return False
+
+    luma = np.asarray(image.convert("L"))
+    written = luma < 224
+    midtones = written & (luma > 32)
+
+    # Grey strokes, shading and light templates consist of mid-tones only
+    return int(midtones.sum()) <= share * int(written.sum())
+
+
+def reconstruction_error(image: Image, reconstructed: Image) -> float:
+    """Compute the mean difference of pixels that are written in either image."""
+
+    original = np.asarray(image.convert("RGB")).astype(np.int16)
+    decoded = np.asarray(reconstructed.convert("RGB")).astype(np.int16)
+
+    written = (original.min(axis=2) < 224) | (decoded.min(axis=2) < 224)
+    if not written.any():
+        return 0.0
+
+    return float(np.abs(original - decoded).max(axis=2)[written].mean())
+
+
+def encode_image(
+    image: Image,
+    encoding: str | None = None,
+    quality: int = 75,
+    colors: int = 16,
+) -> EncodedImage:
+    """Encode an image for embedding into a PDF file."""
+
+    match encoding:
+        case None | "jpeg":
+            # Without options, this matches Pillow's PDF export, which embeds RGB images as JPEG
+            return encode_jpeg(image, quality)
+        case "jpeg2000":
+            return encode_jpeg2000(image, quality)
+        case "palette":
+            return encode_palette(image, colors)
+        case "bilevel":
+            return encode_bilevel(image)
+        case "auto":
+            # Each page uses the smallest encoding, but lossier encodings than JPEG have to stay faithful
+            candidates = [encode_jpeg(image, quality)]
+
+            palette = encode_palette(image, colors)
+            if reconstruction_error(image, decode_palette(palette)) <= MAX_ERROR:
+                candidates.append(palette)
+
+            # Thresholding would drop grey content, so bilevel is only considered for two-tone pages
+            if is_two_tone(image) and reconstruction_error(image, threshold_bilevel(image)) <= MAX_ERROR:
+                candidates.append(encode_bilevel(image))
+
+            return min(candidates, key=lambda encoded: len(encoded.data))
+        case _:
+            raise ValueError(f"Unknown encoding: {encoding}")
@@ -0,0 +1,147 @@
+import contextlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# Linux limits the size of a single environment variable to 128 KiB
+ENVIRONMENT_LIMIT = 64 * 1024
+
+
+def terminate_process(process: subprocess.Popen, grace: float = 5):
+    """Terminate a process together with its children, killing them if they don't exit in time."""
+
+    if not hasattr(os, "killpg"):
+        process.kill()
+        process.wait()
+        return
+
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signum)
+
+        with contextlib.suppress(subprocess.TimeoutExpired):
+            process.wait(grace)
+            return
+
+
+def run_hook(
+    command: str, timeout: int | float | None = None, environment: dict[str, str] | None = None
+) -> bool:
+    """Run a shell command and wait until it finishes or times out."""
+
+    started = time.monotonic()
+
+    # The shell gets its own process group, so commands started by it are terminated on timeout too
+    process = subprocess.Popen(
+        command, shell=True, env={**os.environ, **(environment or {})}, start_new_session=True
+    )
+
+    try:
+        code = process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        logging.warning("Hook timed out after %s seconds: %s", timeout, command)
+        terminate_process(process)
+        return False
+
+    if code != 0:
+        logging.warning("Hook failed with exit code %d: %s", code, command)
+        return False
+
+    logging.info("Hook finished in %.1f s: %s", time.monotonic() - started, command)
+    return True
+
+
+def write_manifest(filename: str, changes: dict[str, str]) -> dict[str, str]:
+    """Write a manifest of changed files and return environment variables that describe it."""
+
+    written = sorted(path.replace(os.sep, "/") for path, change in changes.items() if change == "written")
+    deleted = sorted(path.replace(os.sep, "/") for path, change in changes.items() if change == "deleted")
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    temporary = filename + ".tmp"
+
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump({"written": written, "deleted": deleted}, file, indent=2)
+
+    os.replace(temporary, filename)
+
+    environment = {"MATHNOTES_MANIFEST": filename}
+
+    # Paths are also listed one per line in variables, so simple shell hooks don't need to parse JSON
+    lists = {"MATHNOTES_WRITTEN": "\n".join(written), "MATHNOTES_DELETED": "\n".join(deleted)}
+
+    if sum(len(value) for value in lists.values()) <= ENVIRONMENT_LIMIT:
+        environment.update(lists)
+    else:
+        logging.warning("Too many changed files for environment variables, only the manifest lists them")
+
+    return environment
+
+
+class HookRunner:
+    """Run a hook in the background, coalescing requests made while it is already running."""
+
+    def __init__(self, manifest: str):
+        self.manifest = manifest
+
+        self.condition = threading.Condition()
+        self.request: tuple[str, int | float | None] | None = None
+        self.pending: dict[str, str] = {}
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, name="HookRunner", daemon=True)
+
+    def start(self):
+        """Start running hooks in a background thread."""
+
+        self.thread.start()
+
+    def stop(self):
+        """Stop running hooks after the current and the queued run."""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        self.thread.join()
+
+    def submit(self, command: str, timeout: int | float | None, changes: dict[str, str]):
+        """Request a run of the hook, adding the changed files to files of requests that did not run yet."""
+
+        with self.condition:
+            for path, change in changes.items():
+                self.pending.pop(path, None)
+                self.pending[path] = change
+
+            self.request = (command, timeout)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.request is None:
+                    self.condition.wait()
+
+                # A request made before stopping still runs, so the last changes are not lost
+                if self.request is None:
+                    return
+
+                # Requests made while the hook was running are combined into a single run
+                (command, timeout), self.request = self.request, None
+                changes, self.pending = self.pending, {}
+
+            try:
+                success = run_hook(command, timeout, write_manifest(self.manifest, changes))
+            except Exception as error:
+                logging.exception("Failed to run hook: %s", error)
+                success = False
+
+            with self.condition:
+                # Changes of failed runs are reported again with the next run, unless they changed since
+                if not success:
+                    self.pending = {**changes, **self.pending}
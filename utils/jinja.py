@@ -1,22 +1,51 @@
+import functools
+import hashlib
 import os
 
-from jinja2 import Environment, FileSystemLoader
-
 from .dates import format_datetime, parse_datetime
 from .text import slugify
 
 
-def prepare_environment():
-    """Create and configure a Jinja2 environment."""
+def asset_url(context, path: str) -> str:
+    """Return the URL of an asset, which may be renamed when assets are fingerprinted."""
+
+    return context.get("assets", {}).get(path, path)
+
+
+@functools.cache
+def prepare_environment(cache: str):
+    """Create and configure a Jinja2 environment, shared by the whole process."""
+
+    # Jinja2 is only imported when templates are rendered, so commands that don't render start faster
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, pass_context
 
     dirname = os.path.dirname(os.path.dirname(__file__))
 
+    # Compiled templates are kept in memory and in the bytecode cache, and only recompiled when they change
     loader = FileSystemLoader(searchpath=os.path.join(dirname, "templates"))
-    environment = Environment(loader=loader, autoescape=True)
+    os.makedirs(cache, exist_ok=True)
+    bytecode_cache = FileSystemBytecodeCache(cache)
+    environment = Environment(loader=loader, bytecode_cache=bytecode_cache, autoescape=True)
     environment.filters["slugify"] = slugify
     environment.filters["parse_datetime"] = parse_datetime
     environment.filters["format_datetime"] = format_datetime
+    environment.filters["asset"] = pass_context(asset_url)
     environment.trim_blocks = True
     environment.lstrip_blocks = True
 
     return environment
+
+
+def template_digest() -> str:
+    """Compute a digest of all templates, so outputs can be rendered again when they change."""
+
+    dirname = os.path.join(os.path.dirname(os.path.dirname(__file__)), "templates")
+    digest = hashlib.sha256()
+
+    for name in sorted(os.listdir(dirname)):
+        digest.update(name.encode("utf-8"))
+
+        with open(os.path.join(dirname, name), "rb") as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
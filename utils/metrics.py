@@ -0,0 +1,213 @@
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from dataclasses import dataclass
+
+
+def read_io() -> tuple[int, int] | None:
+    """Return the number of bytes read and written by the current process, if available."""
+
+    try:
+        with open("/proc/self/io") as file:
+            values = dict(line.split(": ") for line in file.read().splitlines())
+    except OSError:
+        return None
+
+    return int(values["rchar"]), int(values["wchar"])
+
+
+def read_peak_rss() -> int:
+    """Return the peak resident set size of the current process in bytes since the last reset."""
+
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Other systems only report the peak over the whole lifetime of the process
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the current process, if supported."""
+
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+
+
+@dataclass
+class Frame:
+    name: str
+    document: str | None
+    wall: float
+    cpu: float
+    io: tuple[int, int] | None
+    peak: int = 0
+
+
+class Recorder:
+    """Measure wall time, CPU time, I/O and peak memory of pipeline stages."""
+
+    def __init__(self):
+        self.enabled = False
+        self.profile = False
+        self.jsonl: str | None = None
+        self.prometheus: str | None = None
+
+        self.stack: list[Frame] = []
+        self.records: list[dict] = []
+        self.totals: dict[str, dict[str, float]] = {}
+
+    def configure(self, profile: bool = False, jsonl: str | None = None, prometheus: str | None = None):
+        """Enable measurements and set where they are reported."""
+
+        self.profile = profile
+        self.jsonl = jsonl
+        self.prometheus = prometheus
+        self.enabled = bool(profile or jsonl or prometheus)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, document: str | None = None):
+        """Measure a stage, which can also be nested in other stages or used as a decorator."""
+
+        if not self.enabled:
+            yield
+            return
+
+        if self.stack:
+            # The peak is reset for the nested stage, so the parent has to remember its own peak first
+            self.stack[-1].peak = max(self.stack[-1].peak, read_peak_rss())
+            document = document or self.stack[-1].document
+
+        reset_peak_rss()
+
+        frame = Frame(name, document, time.perf_counter(), time.process_time(), read_io())
+        self.stack.append(frame)
+
+        try:
+            yield
+        finally:
+            self.stack.pop()
+
+            frame.peak = max(frame.peak, read_peak_rss())
+            if self.stack:
+                self.stack[-1].peak = max(self.stack[-1].peak, frame.peak)
+
+            io = read_io()
+
+            self.records.append(
+                {
+                    "timestamp": time.time(),
+                    "stage": name,
+                    "path": "/".join([*(parent.name for parent in self.stack), name]),
+                    "document": document,
+                    "wall": time.perf_counter() - frame.wall,
+                    "cpu": time.process_time() - frame.cpu,
+                    "read": io[0] - frame.io[0] if io and frame.io else None,
+                    "written": io[1] - frame.io[1] if io and frame.io else None,
+                    "peak_rss": frame.peak,
+                }
+            )
+
+    def collect(self) -> list[dict]:
+        """Remove and return all measurements that were not reported yet."""
+
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records: list[dict]):
+        """Add measurements made in another process."""
+
+        self.records.extend(records)
+
+    def flush(self):
+        """Report all measurements made since the last flush."""
+
+        records = self.collect()
+
+        if not records:
+            return
+
+        for record in records:
+            totals = self.totals.setdefault(
+                record["stage"],
+                {"calls": 0, "wall": 0.0, "cpu": 0.0, "read": 0, "written": 0, "peak_rss": 0},
+            )
+
+            totals["calls"] += 1
+            totals["wall"] += record["wall"]
+            totals["cpu"] += record["cpu"]
+            totals["read"] += record["read"] or 0
+            totals["written"] += record["written"] or 0
+            totals["peak_rss"] = max(totals["peak_rss"], record["peak_rss"])
+
+        if self.profile:
+            self.log(records)
+
+        if self.jsonl:
+            with open(self.jsonl, "a", encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record) + "\n")
+
+        if self.prometheus:
+            self.write_prometheus()
+
+    def log(self, records: list[dict]):
+        """Log a summary of each stage."""
+
+        summary: dict[str, list[dict]] = {}
+        for record in records:
+            summary.setdefault(record["path"], []).append(record)
+
+        for path, measured in summary.items():
+            logging.info(
+                "Profile: %s: %d calls, %.3f s wall, %.3f s CPU, %d B read, %d B written, %.1f MB peak",
+                path,
+                len(measured),
+                sum(record["wall"] for record in measured),
+                sum(record["cpu"] for record in measured),
+                sum(record["read"] or 0 for record in measured),
+                sum(record["written"] or 0 for record in measured),
+                max(record["peak_rss"] for record in measured) / 1024 / 1024,
+            )
+
+    def write_prometheus(self):
+        """Write the totals of all stages in the Prometheus text format for the node exporter."""
+
+        metrics = [
+            ("calls", "mathnotes_stage_calls_total", "counter", "Number of times the stage ran."),
+            ("wall", "mathnotes_stage_wall_seconds_total", "counter", "Wall time spent in the stage."),
+            ("cpu", "mathnotes_stage_cpu_seconds_total", "counter", "CPU time spent in the stage."),
+            ("read", "mathnotes_stage_read_bytes_total", "counter", "Bytes read during the stage."),
+            ("written", "mathnotes_stage_written_bytes_total", "counter", "Bytes written during the stage."),
+            ("peak_rss", "mathnotes_stage_peak_rss_bytes", "gauge", "Peak resident memory during the stage."),
+        ]
+
+        lines = []
+
+        for key, metric, kind, description in metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for stage, totals in sorted(self.totals.items()):
+                lines.append(f'{metric}{{stage="{stage}"}} {totals[key]}')
+
+        # The node exporter may read the file at any time, so it is replaced atomically
+        temporary = self.prometheus + ".tmp"
+
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+        os.replace(temporary, self.prometheus)
+
+
+recorder = Recorder()
+stage = recorder.stage
@@ -15,14 +15,27 @@ class MetaConfig(BaseModel):
 
 
 class HookConfig(BaseModel):
+    """Commands run around processing. Publishing hooks must exclude the .cache directory of the target."""
+
     pre: str | None = None
     post: str | None = None
+    timeout: int | float | None = None
 
 
 class ConversionConfig(BaseModel):
     repaginate: bool = True
     dpi: int | float = 300
     height: int | float = 297
+    streaming: bool = False
+    workers: int = 1
+    cache_size: int = 0
+    incremental: bool = False
+    incremental_cache_size: int = 256
+    vector: bool = False
+    analysis_dpi: int | float | None = None
+    encoding: Literal["jpeg", "jpeg2000", "palette", "bilevel", "auto"] | None = None
+    quality: int = Field(75, ge=1, le=100)
+    colors: int = Field(16, ge=2, le=256)
 
 
 class IndexConfig(BaseModel):
@@ -31,6 +44,26 @@ class IndexConfig(BaseModel):
     depth: int = -1
 
 
+class StaticConfig(BaseModel):
+    minify: bool = False
+    fingerprint: bool = False
+    precompress: bool = False
+
+
+class WatchConfig(BaseModel):
+    debounce: int | float = 2
+
+
+class MetricsConfig(BaseModel):
+    jsonl: str | None = None
+    prometheus: str | None = None
+
+
+class MetadataConfig(BaseModel):
+    backend: Literal["json", "sqlite"] = "json"
+    export: bool = False
+
+
 class DirectoriesConfig(BaseModel):
     source: str
     target: str
@@ -48,6 +81,10 @@ class BaseConfig(BaseModel):
     hooks: HookConfig = Field(default_factory=HookConfig)
     conversion: ConversionConfig = Field(default_factory=ConversionConfig)
     index: IndexConfig = Field(default_factory=IndexConfig)
+    static: StaticConfig = Field(default_factory=StaticConfig)
+    watch: WatchConfig = Field(default_factory=WatchConfig)
+    metrics: MetricsConfig = Field(default_factory=MetricsConfig)
+    metadata: MetadataConfig = Field(default_factory=MetadataConfig)
     directories: DirectoriesConfig
     layouts: list[LayoutConfig]
 
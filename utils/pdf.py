@@ -1,10 +1,12 @@
+import contextlib
+import os
 import time
 
 import pikepdf
 
 
 def set_pdf_metadata(
-    filename: str,
+    pdf: pikepdf.Pdf,
     title: str | None = None,
     description: str | None = None,
     subject: str | None = None,
@@ -13,23 +15,46 @@ def set_pdf_metadata(
     modified: time.struct_time | None = None,
     converted: time.struct_time | None = None,
 ):
-    """Set metadata for a PDF file."""
-
-    with pikepdf.Pdf.open(filename, allow_overwriting_input=True) as pdf:
-        with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
-            if title is not None:
-                meta["dc:title"] = title
-            if description is not None:
-                meta["dc:description"] = description
-            if subject is not None:
-                meta["dc:subject"] = [subject]
-            if author is not None:
-                meta["dc:creator"] = [author]
-            if language is not None:
-                meta["dc:language"] = [language]
-            if modified is not None:
-                meta["xmp:ModifyDate"] = time.strftime("%Y-%m-%dT%H:%M:%S", modified)
-            if converted is not None:
-                meta["xmp:MetadataDate"] = time.strftime("%Y-%m-%dT%H:%M:%S", converted)
-            meta["xmp:CreatorTool"] = "MathNotes"
-        pdf.save()
+    """Set metadata for an open PDF file."""
+
+    with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
+        if title is not None:
+            meta["dc:title"] = title
+        if description is not None:
+            meta["dc:description"] = description
+        if subject is not None:
+            meta["dc:subject"] = [subject]
+        if author is not None:
+            meta["dc:creator"] = [author]
+        if language is not None:
+            meta["dc:language"] = [language]
+        if modified is not None:
+            meta["xmp:ModifyDate"] = time.strftime("%Y-%m-%dT%H:%M:%S", modified)
+        if converted is not None:
+            meta["xmp:MetadataDate"] = time.strftime("%Y-%m-%dT%H:%M:%S", converted)
+        meta["xmp:CreatorTool"] = "MathNotes"
+
+
+def save_pdf(pdf: pikepdf.Pdf, filename: str, metadata: dict | None = None, **options):
+    """Save a PDF file together with its metadata in a single write, atomically replacing the old file."""
+
+    if metadata is not None:
+        set_pdf_metadata(pdf, **metadata)
+
+    temporary = filename + ".tmp"
+
+    try:
+        pdf.save(temporary, **options)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary)
+        raise
+
+    os.replace(temporary, filename)
+
+
+def update_pdf_metadata(filename: str, metadata: dict):
+    """Replace metadata of an existing PDF file, keeping its content unchanged."""
+
+    with pikepdf.open(filename) as pdf:
+        save_pdf(pdf, filename, metadata, object_stream_mode=pikepdf.ObjectStreamMode.preserve)
@@ -0,0 +1,98 @@
+import heapq
+import os
+import threading
+import time
+from collections.abc import Callable
+
+
+class ReadinessTracker:
+    """Track files that are still being written and report each one as soon as it is complete."""
+
+    def __init__(self, ready: Callable[[str], None], interval: float = 1):
+        self.ready = ready
+        self.interval = interval
+
+        self.condition = threading.Condition()
+        self.files: dict[str, tuple[int, int] | None] = {}
+        self.timers: list[tuple[float, str]] = []
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, name="ReadinessTracker", daemon=True)
+
+    def start(self):
+        """Start checking tracked files in a background thread."""
+
+        self.thread.start()
+
+    def stop(self):
+        """Stop checking tracked files."""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        self.thread.join()
+
+    def track(self, path: str):
+        """Start tracking a file that is being written."""
+
+        path = os.path.abspath(path)
+
+        with self.condition:
+            if path in self.files:
+                return
+
+            self.files[path] = None
+            heapq.heappush(self.timers, (time.monotonic() + self.interval, path))
+            self.condition.notify()
+
+    def complete(self, path: str):
+        """Report a tracked file as complete, for example after it was closed for writing."""
+
+        path = os.path.abspath(path)
+
+        with self.condition:
+            if self.files.pop(path, False) is False:
+                return
+
+        self.ready(path)
+
+    def __contains__(self, path: str) -> bool:
+        """Check whether a file is still being written."""
+
+        with self.condition:
+            return os.path.abspath(path) in self.files
+
+    def run(self):
+        # All tracked files share a single timer queue instead of blocking a thread each
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.timers or self.timers[0][0] > time.monotonic()):
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+
+                if self.stopped:
+                    return
+
+                _, path = heapq.heappop(self.timers)
+
+                # The file was already completed by an event
+                if path not in self.files:
+                    continue
+
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self.files[path]
+                    continue
+
+                # Files are stable when their size and modification time did not change since the last check
+                current = (stat.st_size, stat.st_mtime_ns)
+
+                if self.files[path] != current:
+                    self.files[path] = current
+                    heapq.heappush(self.timers, (time.monotonic() + self.interval, path))
+                    continue
+
+                del self.files[path]
+
+            self.ready(path)
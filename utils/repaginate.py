@@ -1,76 +1,205 @@
 from __future__ import annotations
 
+import collections
+import hashlib
+import itertools
+import json
 import logging
+import math
+from collections.abc import Iterable, Iterator
 
 import numpy as np
-import pdfplumber
+import pikepdf
 from PIL import Image
 
+from .cache import PageCache
+from .document import SourceDocument
+from .encoding import EncodedImage, encode_image
+from .metrics import stage
+from .pdf import save_pdf
 
+
+@stage("rasterize")
 def combine_pages(
-    filename: str,
+    document: SourceDocument,
     dpi: int | float = 300,
 ) -> Image:
     """Combine all pages of a PDF into a single image."""
 
-    with pdfplumber.open(filename) as pdf:
-        images = []
+    images = []
 
-        width = 0
-        height = 0
+    width = 0
+    height = 0
 
-        for page in pdf.pages:
-            image = page.to_image(resolution=dpi, antialias=True).original
-            images.append(image)
-            width = max(width, image.width)
-            height += image.height
+    for index in range(len(document.pdfium)):
+        image = document.render_page(index, dpi=dpi)
+        images.append(image)
+        width = max(width, image.width)
+        height += image.height
 
-        combined = Image.new("RGB", (width, height), "white")
-        position = 0
+    combined = Image.new("RGB", (width, height), "white")
+    position = 0
 
-        for image in images:
-            combined.paste(image, (0, position))
-            position += image.height
+    for image in images:
+        combined.paste(image, (0, position))
+        position += image.height
 
     return combined
 
 
+def render_pages(
+    document: SourceDocument,
+    dpi: int | float = 300,
+    start: int = 0,
+) -> Iterator[Image]:
+    """Render pages of a PDF one at a time, padded to the widest page."""
+
+    sizes = document.page_sizes()
+    width = max((math.ceil(page_width * dpi / 72) for page_width, _ in sizes), default=0)
+
+    for index in range(start, len(sizes)):
+        image = document.render_page(index, dpi=dpi)
+
+        if image.width != width:
+            padded = Image.new("RGB", (width, image.height), "white")
+            padded.paste(image, (0, 0))
+            image = padded
+
+        yield image
+
+
+def line_brightness(image: Image) -> np.ndarray:
+    """Compute the scaled mean brightness of each pixel row in the image."""
+
+    pixels = np.asarray(image.convert("L"))
+
+    # Integer row sums are exact, so scaling them afterwards gives the same values as scaling every pixel
+    return pixels.sum(axis=1, dtype=np.int64) * 100 / pixels.shape[1]
+
+
+def rolling_median_mask(
+    lines: np.ndarray,
+    median_window: int,
+    median_threshold: int | float,
+) -> np.ndarray:
+    """Find which rolling medians of the values reach the threshold."""
+
+    lower = (median_window - 1) // 2
+    upper = median_window // 2
+
+    # The median reaches the threshold when enough values in the window do
+    above = np.concatenate(([0], np.cumsum(lines >= median_threshold)))
+    counts = above[median_window:] - above[:-median_window]
+    mask = counts >= median_window - lower
+
+    # For even windows the median is the mean of two middle values, which only needs sorting when they straddle the threshold
+    ambiguous = np.flatnonzero(~mask & (counts >= median_window - upper))
+
+    if ambiguous.size:
+        view = np.lib.stride_tricks.sliding_window_view(lines, (median_window,))[ambiguous]
+        middle = np.partition(view, (lower, upper), axis=1)
+        mask[ambiguous] = (middle[:, lower] + middle[:, upper]) / 2 >= median_threshold
+
+    return mask
+
+
+class SplitDetector:
+    """Incrementally find possible horizontal splits from row brightness values."""
+
+    def __init__(
+        self,
+        median_window: int = 10,
+        median_threshold: int = 25050,
+        split_height: int = 30,
+        split_margin: int = 30,
+    ):
+        self.median_window = median_window
+        self.median_threshold = median_threshold
+        self.split_height = split_height
+        self.split_margin = split_margin
+
+        self.position = 0
+        self.split_start = None
+        self.pending = np.empty(0)
+
+    def feed(self, lines: np.ndarray) -> list[int]:
+        """Consume the next rows and return splits that were decided by them."""
+
+        # Keep the last rows of the previous chunk so the median window spans chunk boundaries
+        lines = np.concatenate((self.pending, lines))
+        self.pending = lines[max(len(lines) - self.median_window + 1, 0) :]
+
+        if len(lines) < self.median_window:
+            return []
+
+        mask = rolling_median_mask(lines, self.median_window, self.median_threshold)
+
+        # Edges of whitespace runs, with a run that is still open from the previous chunk included
+        edges = np.flatnonzero(np.diff(np.concatenate(([self.split_start is not None], mask, [False]))))
+        edges += self.position
+
+        if self.split_start is not None:
+            edges = np.concatenate(([self.split_start], edges))
+
+        starts = edges[::2]
+        ends = edges[1::2]
+
+        self.position += len(mask)
+
+        # The last run may continue in the next chunk
+        if len(ends) and ends[-1] == self.position:
+            self.split_start = int(starts[-1])
+            starts = starts[:-1]
+            ends = ends[:-1]
+        else:
+            self.split_start = None
+
+        valid = ends - starts >= self.split_height
+        starts = starts[valid]
+        ends = ends[valid]
+
+        return np.maximum((starts + ends) // 2, ends - self.split_margin).tolist()
+
+    def finish(self) -> list[int]:
+        """Return the split that is decided by the end of the input."""
+
+        if self.split_start is not None and self.position - self.split_start >= self.split_height:
+            return [self.split_start + self.split_margin]
+
+        return []
+
+
+@stage("split")
 def find_possible_splits(
     image: Image,
     median_window: int = 10,
     median_threshold: int = 25050,
     split_height: int = 30,
     split_margin: int = 30,
+    downsample: int = 1,
 ) -> list[int]:
     """Find all possible horizontal splits in the image."""
 
-    gray = image.convert("L")
-    pixels = np.asarray(gray).astype("uint16") * 100
-    lines = pixels.mean(axis=1)
-    view = np.lib.stride_tricks.sliding_window_view(lines, (median_window,))
-    medians = np.median(view, axis=1)
-
-    splits = []
-
-    split_start = None
-
-    for position, median in enumerate(medians):
-        if median >= median_threshold:
-            if split_start is None:
-                split_start = position
-
-        else:
-            if split_start is not None:
-                if position - split_start >= split_height:
-                    splits.append(max((split_start + position) // 2, position - split_margin))
-                split_start = None
+    if downsample > 1:
+        # Analyse a smaller image and scale the positions back, which is faster but less precise
+        image = image.reduce(downsample)
+        median_window = max(median_window // downsample, 1)
+        split_height = max(split_height // downsample, 1)
+        split_margin = split_margin // downsample
+
+    detector = SplitDetector(
+        median_window=median_window,
+        median_threshold=median_threshold,
+        split_height=split_height,
+        split_margin=split_margin,
+    )
 
-    if split_start is not None and len(medians) - split_start >= split_height:
-        splits.append(split_start + split_margin)
+    splits = detector.feed(line_brightness(image)) + detector.finish()
 
-    return splits
+    return [split * downsample for split in splits]
 
 
+@stage("optimize")
 def find_optimal_splits(
     possible: list[int],
     page_height: int | float,
@@ -93,6 +222,7 @@ def find_optimal_splits(
     return splits
 
 
+@stage("slice")
 def slice_image(
     image: Image,
     splits: list[int],
@@ -116,26 +246,462 @@ def slice_image(
     return images
 
 
+class Repaginator:
+    """Incrementally repaginate a stream of images, cutting output pages as soon as their splits are decided."""
+
+    def __init__(self, page_height: int | float):
+        self.page_height = page_height
+        self.detector = SplitDetector()
+
+        # Source images that still overlap the pending output page, with their vertical offsets
+        self.band: list[tuple[int, Image]] = []
+        self.band_end = 0
+
+        self.position = 0
+        self.current_start = 0
+        self.current_end = 0
+
+    def add(self, image: Image, analyse: bool = True) -> list[Image]:
+        """Append the next image and return output pages that were completed by it."""
+
+        self.band.append((self.band_end, image))
+        self.band_end += image.height
+
+        if not analyse:
+            return []
+
+        return self.decide(self.detector.feed(line_brightness(image)))
+
+    def finish(self) -> list[Image]:
+        """Return the remaining output pages after the last image."""
+
+        pages = self.decide(self.detector.finish())
+
+        if self.band and self.position < self.band_end:
+            pages.append(self.cut(self.band_end))
+
+        return pages
+
+    def decide(self, splits: list[int]) -> list[Image]:
+        pages = []
+
+        for split in splits:
+            if split - self.current_start <= self.page_height:
+                self.current_end = split
+            else:
+                pages.append(self.cut(self.current_end))
+                self.current_start = split
+                self.current_end = split
+
+        return pages
+
+    def cut(self, split: int) -> Image:
+        width = self.band[0][1].width
+        output = Image.new("RGB", (width, split - self.position), "white")
+
+        for offset, image in self.band:
+            if offset < split and offset + image.height > self.position:
+                box = (0, max(self.position - offset, 0), width, min(split - offset, image.height))
+                output.paste(image.crop(box), (0, max(offset - self.position, 0)))
+
+        self.band = [(offset, image) for offset, image in self.band if offset + image.height > split]
+        self.position = split
+
+        return output
+
+    def state(self) -> dict:
+        """Return the analysis state, without the images in the band."""
+
+        return {
+            "band_start": self.band[0][0] if self.band else self.band_end,
+            "band_size": len(self.band),
+            "band_end": self.band_end,
+            "position": self.position,
+            "current_start": self.current_start,
+            "current_end": self.current_end,
+            "detector_position": self.detector.position,
+            "detector_split_start": self.detector.split_start,
+            "detector_pending": self.detector.pending.tolist(),
+        }
+
+    def restore(self, state: dict):
+        """Restore the analysis state, after which the band images must be added again without analysis."""
+
+        self.band = []
+        self.band_end = state["band_start"]
+        self.position = state["position"]
+        self.current_start = state["current_start"]
+        self.current_end = state["current_end"]
+        self.detector.position = state["detector_position"]
+        self.detector.split_start = state["detector_split_start"]
+        self.detector.pending = np.array(state["detector_pending"], dtype=float)
+
+
+def stream_pages(
+    pages: Iterable[Image],
+    page_height: int | float,
+) -> Iterator[Image]:
+    """Repaginate a stream of images, emitting each output page as soon as its split is decided."""
+
+    repaginator = Repaginator(page_height)
+
+    for image in pages:
+        yield from repaginator.add(image)
+
+    yield from repaginator.finish()
+
+
+def slice_pages(
+    pages: Iterable[Image],
+    splits: list[int],
+) -> Iterator[Image]:
+    """Slice a stream of images at already known splits, emitting each output page as soon as it is complete."""
+
+    repaginator = Repaginator(0)
+    remaining = iter(splits)
+    split = next(remaining, None)
+
+    for image in pages:
+        repaginator.add(image, analyse=False)
+
+        while split is not None and split <= repaginator.band_end:
+            yield repaginator.cut(split)
+            split = next(remaining, None)
+
+    if repaginator.band and repaginator.position < repaginator.band_end:
+        yield repaginator.cut(repaginator.band_end)
+
+
+@stage("export")
+def export_encoded_pdf(
+    images: Iterable[EncodedImage],
+    filename: str,
+    dpi: int | float = 300,
+    metadata: dict | None = None,
+):
+    """Export already encoded images into a single PDF file."""
+
+    sizes = collections.Counter()
+    pages = collections.Counter()
+
+    with pikepdf.new() as pdf:
+        for index, image in enumerate(images):
+            xobject = pikepdf.Stream(pdf, image.data)
+            xobject.Type = pikepdf.Name.XObject
+            xobject.Subtype = pikepdf.Name.Image
+            xobject.Width = image.width
+            xobject.Height = image.height
+            xobject.BitsPerComponent = image.bits
+            xobject.Filter = pikepdf.Name(image.filter)
+
+            if image.palette is not None:
+                palette = bytes.fromhex(image.palette)
+                xobject.ColorSpace = pikepdf.Array(
+                    [
+                        pikepdf.Name.Indexed,
+                        pikepdf.Name.DeviceRGB,
+                        len(palette) // 3 - 1,
+                        pikepdf.String(palette),
+                    ]
+                )
+            else:
+                xobject.ColorSpace = pikepdf.Name(image.colorspace)
+
+            if image.filter == "/CCITTFaxDecode":
+                xobject.DecodeParms = pikepdf.Dictionary(
+                    K=-1,
+                    BlackIs1=True,
+                    Columns=image.width,
+                    Rows=image.height,
+                )
+
+            logging.debug("Encoded page %d as %s: %d bytes", index + 1, image.encoding, len(image.data))
+            sizes[image.encoding] += len(image.data)
+            pages[image.encoding] += 1
+
+            width = image.width * 72 / dpi
+            height = image.height * 72 / dpi
+
+            page = pdf.add_blank_page(page_size=(width, height))
+            page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=xobject))
+            page.Contents = pdf.make_stream(f"q {width:.4f} 0 0 {height:.4f} 0 0 cm /Im0 Do Q".encode())
+
+        save_pdf(pdf, filename, metadata)
+
+    for encoding, count in pages.items():
+        logging.info("Encoded %d pages as %s: %d bytes per page", count, encoding, sizes[encoding] // count)
+
+
 def export_pdf(
-    images: list[Image],
+    images: Iterable[Image],
     filename: str,
     dpi: int | float = 300,
+    metadata: dict | None = None,
+    **options,
+):
+    """Export images into a single PDF file, encoding each image as soon as it is produced."""
+
+    encoded = (encode_image(image, **options) for image in images)
+    export_encoded_pdf(encoded, filename, dpi=dpi, metadata=metadata)
+
+
+def digest_object(obj, digest, seen: set):
+    """Feed the content of a PDF object and everything it references into a digest."""
+
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        # Only object contents are hashed, as object numbers change between exports
+        if obj.objgen in seen:
+            digest.update(b"R")
+            return
+        seen.add(obj.objgen)
+
+    if isinstance(obj, pikepdf.Dictionary | pikepdf.Stream):
+        for key in sorted(obj.keys()):
+            if key in ("/Parent", "/Length"):
+                continue
+            digest.update(key.encode())
+            digest_object(obj[key], digest, seen)
+
+        if isinstance(obj, pikepdf.Stream):
+            digest.update(obj.read_raw_bytes())
+
+    elif isinstance(obj, pikepdf.Array):
+        digest.update(b"[")
+        for item in obj:
+            digest_object(item, digest, seen)
+        digest.update(b"]")
+
+    else:
+        digest.update(repr(obj).encode())
+
+
+@stage("fingerprint")
+def fingerprint_pages(document: SourceDocument, **parameters) -> list[str]:
+    """Compute fingerprints of each page that also cover all previous pages."""
+
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+    fingerprints = []
+
+    for page in document.pdf.pages:
+        digest_object(page.obj, digest, set())
+        fingerprints.append(digest.copy().hexdigest())
+
+    return fingerprints
+
+
+def repaginate_incremental(
+    document: SourceDocument,
+    output_filename: str,
+    cache: PageCache,
+    page_height: int | float,
+    dpi: int | float = 300,
+    metadata: dict | None = None,
+    **options,
 ):
-    """Export images into a single PDF file."""
+    """Repaginate a PDF file, reusing the work for unchanged leading pages from the previous run."""
+
+    fingerprints = fingerprint_pages(document, dpi=dpi, page_height=page_height, **options)
+    previous = cache.load()
+
+    # Fingerprints cover all previous pages, so the first mismatch ends the reusable prefix
+    reused = 0
+    for old, new in zip(previous["fingerprints"], fingerprints, strict=False):
+        if old != new:
+            break
+        reused += 1
+
+    repaginator = Repaginator(page_height)
+    checkpoints = previous["checkpoints"][:reused]
+
+    if reused:
+        logging.info("Reusing %d unchanged pages", reused)
+        state = checkpoints[-1]
+        repaginator.restore(state)
+        outputs = previous["outputs"][: state["outputs"]]
+        start = reused - state["band_size"]
+    else:
+        outputs = []
+        start = 0
+
+    def emit(images: list[Image]):
+        for image in images:
+            encoded = encode_image(image, **options)
+            cache.write_output(len(outputs), encoded.data)
+            outputs.append({key: value for key, value in encoded._asdict().items() if key != "data"})
+
+    # Pages in the pending band of the checkpoint are rendered again, as only their analysis is stored
+    for index, image in enumerate(render_pages(document, dpi=dpi, start=start), start=start):
+        if index < reused:
+            repaginator.add(image, analyse=False)
+            continue
+
+        emit(repaginator.add(image))
+        checkpoints.append({**repaginator.state(), "outputs": len(outputs)})
+
+    emit(repaginator.finish())
+
+    export_encoded_pdf(
+        (EncodedImage(cache.read_output(index), **output) for index, output in enumerate(outputs)),
+        output_filename,
+        dpi=dpi,
+        metadata=metadata,
+    )
+
+    cache.save({"fingerprints": fingerprints, "checkpoints": checkpoints, "outputs": outputs})
+
+
+def measure_pages(
+    document: SourceDocument,
+    dpi: int | float = 300,
+) -> tuple[list[int], int]:
+    """Compute the rendered heights of all pages and the widest page width without rendering them."""
+
+    sizes = document.page_sizes()
+
+    heights = [math.ceil(page_height * dpi / 72) for _, page_height in sizes]
+    width = max((math.ceil(page_width * dpi / 72) for page_width, _ in sizes), default=0)
+
+    return heights, width
+
 
-    images[0].save(
-        filename,
-        save_all=True,
-        append_images=images[1:],
-        resolution=dpi,
+@stage("analyse")
+def analyse_pages(
+    document: SourceDocument,
+    page_height: int | float,
+    dpi: int | float = 300,
+    analysis_dpi: int | float | None = None,
+) -> tuple[list[int], list[int], int]:
+    """Find the optimal splits of a PDF file without keeping its rendered pages."""
+
+    if analysis_dpi is None:
+        analysis_dpi = dpi
+
+    # Detection parameters are tuned for the output resolution
+    ratio = analysis_dpi / dpi
+    detector = SplitDetector(
+        median_window=max(round(10 * ratio), 1),
+        split_height=max(round(30 * ratio), 1),
+        split_margin=round(30 * ratio),
     )
 
+    possible = []
+    analysed = []
+    width = 0
+
+    for image in render_pages(document, dpi=analysis_dpi):
+        possible += detector.feed(line_brightness(image))
+        analysed.append(image.height)
+        width = max(width, image.width)
+
+    possible += detector.finish()
+
+    if analysis_dpi == dpi:
+        heights = analysed
+    else:
+        heights, width = measure_pages(document, dpi=dpi)
+        possible = scale_splits(possible, analysed, heights)
 
+    return find_optimal_splits(possible, page_height), heights, width
+
+
+def scale_splits(
+    splits: list[int],
+    source: list[int],
+    target: list[int],
+) -> list[int]:
+    """Map split positions between two renders of the same pages with different heights."""
+
+    positions = np.asarray(splits)
+    source_heights = np.asarray(source)
+    target_heights = np.asarray(target)
+
+    source_offsets = np.concatenate(([0], np.cumsum(source_heights)))
+    target_offsets = np.concatenate(([0], np.cumsum(target_heights)))
+
+    # Positions are scaled within their own page, so rounding of page heights does not accumulate
+    pages = np.clip(np.searchsorted(source_offsets, positions, side="right") - 1, 0, len(source) - 1)
+    local = (positions - source_offsets[pages]) * target_heights[pages] / source_heights[pages]
+
+    return (target_offsets[pages] + np.round(local)).astype(int).tolist()
+
+
+@stage("export")
+def export_vector_pdf(
+    document: SourceDocument,
+    output_filename: str,
+    splits: list[int],
+    heights: list[int],
+    width: int,
+    dpi: int | float = 300,
+    metadata: dict | None = None,
+):
+    """Export the original page content cut at the splits, without rasterizing it."""
+
+    scale = 72 / dpi
+
+    offsets = [0]
+    for height in heights:
+        offsets.append(offsets[-1] + height)
+
+    # Output pages span between consecutive splits, empty pages are skipped
+    edges = [0, *splits, offsets[-1]]
+    pieces = [(top, bottom) for top, bottom in itertools.pairwise(edges) if bottom > top]
+
+    with pikepdf.new() as pdf:
+        # Only objects reachable from the page content are copied, not the embedded Samsung Notes data
+        forms = [pdf.copy_foreign(page.as_form_xobject()) for page in document.pdf.pages]
+
+        for top, bottom in pieces:
+            page_height = (bottom - top) * scale
+            page = pdf.add_blank_page(page_size=(width * scale, page_height))
+            contents = []
+
+            for form, offset, height in zip(forms, offsets, heights, strict=False):
+                if offset >= bottom or offset + height <= top:
+                    continue
+
+                # Align the top of the source page with its position in the combined page stack
+                x0, y0, x1, y1 = (float(value) for value in form.BBox)
+                form_top = page_height - (offset - top) * scale
+                rect = pikepdf.Rectangle(0, form_top - (y1 - y0), x1 - x0, form_top)
+
+                name = page.add_resource(form, pikepdf.Name.XObject, prefix="Fx")
+                contents.append(
+                    page.calc_form_xobject_placement(
+                        form,
+                        name,
+                        rect,
+                        invert_transformations=True,
+                        allow_shrink=False,
+                        allow_expand=False,
+                    )
+                )
+
+            page.Contents = pdf.make_stream(b"\n".join(contents))
+
+        save_pdf(
+            pdf,
+            output_filename,
+            metadata,
+            compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+        )
+
+
+@stage("repaginate")
 def repaginate_pdf(
-    input_filename: str,
+    document: SourceDocument,
     output_filename: str,
     dpi: int | float = 300,
     height: int | float = 297,
+    streaming: bool = False,
+    cache: PageCache | None = None,
+    vector: bool = False,
+    analysis_dpi: int | float | None = None,
+    encoding: str | None = None,
+    quality: int = 75,
+    colors: int = 16,
+    metadata: dict | None = None,
 ):
     """Repaginate a PDF file based on the target page height."""
 
@@ -144,10 +710,42 @@ def repaginate_pdf(
     page_height_mm = height
     page_height_px = int(page_height_mm * dpi / 25.4)
 
-    combined = combine_pages(input_filename, dpi=dpi)
+    output = {"dpi": dpi, "metadata": metadata, "encoding": encoding, "quality": quality, "colors": colors}
+
+    if vector:
+        # Rendering is only used to find the splits, the output keeps the original vector content
+        analysis = analyse_pages(document, page_height_px, dpi=dpi, analysis_dpi=analysis_dpi)
+        export_vector_pdf(document, output_filename, *analysis, dpi=dpi, metadata=metadata)
+        return
+
+    if cache is not None:
+        # Checkpoints store the state of the full resolution analysis, so it cannot use a separate pass
+        repaginate_incremental(document, output_filename, cache, page_height_px, **output)
+        return
+
+    if analysis_dpi is not None and analysis_dpi != dpi:
+        # Splits are found on a cheap low resolution render, and full resolution is only used for the output
+        optimal, _, _ = analyse_pages(document, page_height_px, dpi=dpi, analysis_dpi=analysis_dpi)
+
+        if streaming:
+            pages = render_pages(document, dpi=dpi)
+            export_pdf(slice_pages(pages, optimal), output_filename, **output)
+        else:
+            combined = combine_pages(document, dpi=dpi)
+            export_pdf(slice_image(combined, optimal), output_filename, **output)
+
+        return
+
+    if streaming:
+        # Only the pages overlapping the pending output page are kept in memory
+        pages = render_pages(document, dpi=dpi)
+        export_pdf(stream_pages(pages, page_height_px), output_filename, **output)
+        return
+
+    combined = combine_pages(document, dpi=dpi)
 
     possible = find_possible_splits(combined)
     optimal = find_optimal_splits(possible, page_height_px)
 
     sliced = slice_image(combined, optimal)
-    export_pdf(sliced, output_filename, dpi=dpi)
+    export_pdf(sliced, output_filename, **output)
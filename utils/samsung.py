@@ -1,38 +1,63 @@
 import logging
+import zlib
 
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfparser import PDFParser
-from pdfminer.pdftypes import resolve1
+import pikepdf
 
+from .document import SourceDocument
+from .metrics import stage
 
-def extract_sdocx(input_filename: str, output_filename: str) -> bool:
+CHUNK_SIZE = 1024 * 1024
+
+
+def write_stream(stream: pikepdf.Stream, file):
+    """Decode a PDF stream into a file, without keeping the decoded data in memory."""
+
+    filters = stream.get("/Filter", pikepdf.Array())
+    filters = [filters] if isinstance(filters, pikepdf.Name) else list(filters)
+
+    # pikepdf can only read the raw stream as a whole, but its buffer is used directly instead of copied
+    raw = memoryview(stream.get_raw_stream_buffer())
+
+    if not filters:
+        file.write(raw)
+        return
+
+    if filters != [pikepdf.Name.FlateDecode] or "/DecodeParms" in stream:
+        # Other filters and predictors are rare, so they are decoded by pikepdf in memory
+        file.write(stream.read_bytes())
+        return
+
+    decompressor = zlib.decompressobj()
+    for start in range(0, len(raw), CHUNK_SIZE):
+        file.write(decompressor.decompress(raw[start : start + CHUNK_SIZE]))
+    file.write(decompressor.flush())
+
+
+@stage("sdocx")
+def extract_sdocx(document: SourceDocument, output_filename: str) -> bool:
     """Extract a SDOCX file from the PDF file."""
 
     logging.info("Extracting SDOCX")
 
-    with open(input_filename, "rb") as file:
-        parser = PDFParser(file)
-        document = PDFDocument(parser)
+    catalog = document.catalog
 
-        if "PieceInfo" not in document.catalog:
-            logging.warning("No Samsung Notes data detected")
-            return False
+    if "/PieceInfo" not in catalog:
+        logging.warning("No Samsung Notes data detected")
+        return False
 
-        if "SPenSDK_PAGE_SINGLE" in document.catalog["PieceInfo"]:
-            logging.info("Detected single page document")
-            resolved = resolve1(document.catalog["PieceInfo"]["SPenSDK_PAGE_SINGLE"]["Private"]["Bin0"])
-            data = resolved.get_data()
+    if "/SPenSDK_PAGE_SINGLE" in catalog.PieceInfo:
+        logging.info("Detected single page document")
+        stream = catalog.PieceInfo.SPenSDK_PAGE_SINGLE.Private.Bin0
 
-        elif "SPenSDK_PAGE_LIST" in document.catalog["PieceInfo"]:
-            logging.info("Detected multi page document")
-            resolved = resolve1(document.catalog["PieceInfo"]["SPenSDK_PAGE_LIST"]["Private"]["Bin0"])
-            data = resolved.get_data()
+    elif "/SPenSDK_PAGE_LIST" in catalog.PieceInfo:
+        logging.info("Detected multi page document")
+        stream = catalog.PieceInfo.SPenSDK_PAGE_LIST.Private.Bin0
 
-        else:
-            logging.warning("No Samsung Notes data detected")
-            return False
+    else:
+        logging.warning("No Samsung Notes data detected")
+        return False
 
     with open(output_filename, "wb") as file:
-        file.write(data)
+        write_stream(stream, file)
 
     return True
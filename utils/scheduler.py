@@ -0,0 +1,62 @@
+import logging
+import threading
+import time
+from collections.abc import Callable
+
+
+class BatchScheduler:
+    """Coalesce events into batches that are processed once no new events arrive for a while."""
+
+    def __init__(self, process: Callable[[dict[str, set[str]]], None], delay: float = 2):
+        self.process = process
+        self.delay = delay
+
+        self.condition = threading.Condition()
+        self.pending: dict[str, set[str]] = {}
+        self.updated = 0.0
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run, name="BatchScheduler", daemon=True)
+
+    def start(self):
+        """Start processing batches in a background thread."""
+
+        self.thread.start()
+
+    def stop(self):
+        """Stop processing after the current batch."""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        self.thread.join()
+
+    def submit(self, kind: str, path: str):
+        """Add an event to the pending batch and restart the debounce window."""
+
+        with self.condition:
+            self.pending.setdefault(kind, set()).add(path)
+            self.updated = time.monotonic()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+
+                # Wait until events stop arriving for the whole debounce window
+                while not self.stopped and (remaining := self.updated + self.delay - time.monotonic()) > 0:
+                    self.condition.wait(remaining)
+
+                if self.stopped:
+                    return
+
+                batch, self.pending = self.pending, {}
+
+            # Events that arrive while the batch is processed are collected into the next batch
+            try:
+                self.process(batch)
+            except Exception as error:
+                logging.exception("Failed to process changes: %s", error)
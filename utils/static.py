@@ -0,0 +1,209 @@
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import brotli
+
+from utils.changes import changes
+
+HTML_PROTECTED = re.compile(r"(<(pre|textarea|script|style)\b.*?</\2>)", re.IGNORECASE | re.DOTALL)
+HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+
+CSS_TOKENS = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", re.DOTALL)
+CSS_SPACES = re.compile(r"\s*([{};,>])\s*")
+
+REFERENCES = re.compile(r"""(?<=["'(])/[^"'()\s]+(?=["')])""")
+
+COMPRESSIBLE = {".html", ".css", ".svg", ".ico", ".webmanifest"}
+
+
+def minify_html(content: str) -> str:
+    """Remove comments and collapse whitespace outside of elements where it is significant."""
+
+    parts = HTML_PROTECTED.split(content)
+    result = []
+
+    # Split returns the text, the protected element and its tag name, so every third part is protected
+    for index in range(0, len(parts), 3):
+        text = HTML_COMMENT.sub("", parts[index])
+        result.append(re.sub(r"\s+", " ", text))
+
+        if index + 1 < len(parts):
+            result.append(parts[index + 1])
+
+    return "".join(result).strip()
+
+
+def minify_css(content: str) -> str:
+    """Remove comments and unnecessary whitespace from a stylesheet."""
+
+    result = []
+    code = []
+    position = 0
+
+    # Strings are kept as they are, and comments are removed before the surrounding code is minified
+    for match in CSS_TOKENS.finditer(content):
+        code.append(content[position : match.start()])
+        position = match.end()
+
+        if match.group(1):
+            result.append(minify_css_code("".join(code)))
+            result.append(match.group(1))
+            code = []
+
+    code.append(content[position:])
+    result.append(minify_css_code("".join(code)))
+
+    return "".join(result).strip()
+
+
+def minify_css_code(code: str) -> str:
+    """Remove unnecessary whitespace from a stylesheet without strings and comments."""
+
+    code = re.sub(r"\s+", " ", code)
+    code = CSS_SPACES.sub(r"\1", code)
+
+    # Spaces before colons can be selector combinators, so only spaces after them are removed
+    code = re.sub(r":\s+", ":", code)
+
+    return code.replace(";}", "}")
+
+
+def fingerprint_name(path: str, data: bytes) -> str:
+    """Add a content hash to the filename, so it can be cached forever."""
+
+    base, extension = os.path.splitext(path)
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+def rewrite_references(content: str, urls: dict[str, str]) -> str:
+    """Replace quoted absolute URLs of renamed assets."""
+
+    return REFERENCES.sub(lambda match: urls.get(match.group(0), match.group(0)), content)
+
+
+def compress_file(path: str, data: bytes):
+    """Write gzip and brotli compressed siblings of a file."""
+
+    with open(path + ".gz", "wb") as file:
+        # The timestamp is omitted so unchanged content gives identical files
+        file.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+    with open(path + ".br", "wb") as file:
+        file.write(brotli.compress(data))
+
+
+def remove_compressed(path: str):
+    """Remove compressed siblings of a file."""
+
+    for extension in (".gz", ".br"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + extension)
+            changes.deleted(path + extension)
+
+
+def is_compressible(path: str) -> bool:
+    """Check whether a file is worth compressing."""
+
+    return os.path.splitext(path)[1] in COMPRESSIBLE
+
+
+def write_page(path: str, content: str, minify: bool = False, precompress: bool = False) -> bool:
+    """Write a rendered page unless it is unchanged, keeping its compressed siblings up to date."""
+
+    if minify:
+        content = minify_html(content)
+
+    data = content.encode("utf-8")
+
+    try:
+        with open(path, "rb") as file:
+            changed = file.read() != data
+    except FileNotFoundError:
+        changed = True
+
+    if changed:
+        with open(path, "wb") as file:
+            file.write(data)
+
+        changes.written(path)
+
+    if precompress and (changed or not os.path.isfile(path + ".br") or not os.path.isfile(path + ".gz")):
+        compress_file(path, data)
+        changes.written(path + ".gz")
+        changes.written(path + ".br")
+    elif not precompress:
+        remove_compressed(path)
+
+    return changed
+
+
+def build_assets(
+    source: str,
+    staging: str,
+    minify: bool = False,
+    fingerprint: bool = False,
+    precompress: bool = False,
+) -> dict[str, str]:
+    """Build optimized assets into a staging directory and return URLs of renamed assets."""
+
+    files = {}
+    for root, _, names in os.walk(source):
+        for name in names:
+            path = os.path.relpath(os.path.join(root, name), source).replace(os.sep, "/")
+            with open(os.path.join(source, path), "rb") as file:
+                files[path] = file.read()
+
+    digest = hashlib.sha256(json.dumps([minify, fingerprint, precompress]).encode("utf-8"))
+    for path in sorted(files):
+        digest.update(path.encode("utf-8"))
+        digest.update(hashlib.sha256(files[path]).digest())
+
+    statefile = staging + ".json"
+
+    try:
+        with open(statefile, encoding="utf-8") as file:
+            state = json.load(file)
+        if state["digest"] == digest.hexdigest() and os.path.isdir(staging):
+            return state["urls"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    urls = {}
+    outputs = {}
+
+    # Stylesheets and the manifest reference other assets, so they are processed after them
+    for path in sorted(files, key=lambda path: path.endswith((".css", ".webmanifest"))):
+        data = files[path]
+
+        if path.endswith((".css", ".webmanifest")):
+            content = rewrite_references(data.decode("utf-8"), urls)
+            if minify and path.endswith(".css"):
+                content = minify_css(content)
+            data = content.encode("utf-8")
+
+        # Top level files have well-known URLs, so they keep their names
+        output = fingerprint_name(path, data) if fingerprint and "/" in path else path
+        urls["/" + path] = "/" + output
+        outputs[output] = data
+
+    shutil.rmtree(staging, ignore_errors=True)
+
+    for output, data in outputs.items():
+        path = os.path.join(staging, output)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as file:
+            file.write(data)
+
+        if precompress and is_compressible(output):
+            compress_file(path, data)
+
+    with open(statefile, "w", encoding="utf-8") as file:
+        json.dump({"digest": digest.hexdigest(), "urls": urls}, file, indent=2, sort_keys=True)
+
+    return urls
@@ -0,0 +1,210 @@
+import logging
+import os
+import sqlite3
+
+from utils.changes import changes
+from utils.models import BaseMetadata, DirectoryMetadata, FileMetadata
+from utils.tree import sort_tree
+
+
+def read_metadata(filename: str) -> BaseMetadata:
+    """Read metadata from a JSON file, or return empty metadata if it does not exist."""
+
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf-8") as file:
+            return BaseMetadata.model_validate_json(file.read())
+
+    return BaseMetadata(root={})
+
+
+class MetadataStore:
+    """Metadata of all documents, loaded once and saved only when it changed."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.dirty = False
+        self.changed: set[tuple[str, str]] = set()
+        self._metadata = None
+
+    @property
+    def metadata(self) -> BaseMetadata:
+        """Return the metadata, loading it on the first access."""
+
+        if self._metadata is None:
+            self._metadata = self.load()
+
+            # The content is kept in order from now on, so it only has to be sorted once
+            self._metadata.root = sort_tree(self._metadata.root)
+
+        return self._metadata
+
+    def load(self) -> BaseMetadata:
+        """Load the metadata from the backend."""
+
+        return read_metadata(self.filename)
+
+    def mark_dirty(self):
+        """Mark the whole metadata as changed, so it is saved on the next flush."""
+
+        self.dirty = True
+
+    def mark_changed(self, path: str, slug: str):
+        """Mark a single entry as added, updated or removed, so it is saved on the next flush."""
+
+        self.changed.add((path, slug))
+
+    def flush(self):
+        """Save the metadata if it changed since the last flush."""
+
+        if not self.dirty and not self.changed:
+            return
+
+        logging.info("Saving metadata...")
+
+        self.save()
+
+        self.dirty = False
+        self.changed = set()
+
+    def save(self):
+        """Save the changed metadata to the backend."""
+
+        # The whole file has to be written again, no matter how many entries changed
+        self.export(self.filename)
+
+    def export(self, filename: str):
+        """Atomically write all metadata into a JSON file."""
+
+        temporary = filename + ".tmp"
+
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(self.metadata.model_dump_json(indent=2) + "\n")
+
+        os.replace(temporary, filename)
+        changes.written(filename)
+
+
+class SqliteMetadataStore(MetadataStore):
+    """Metadata of all documents stored as separate entries in a SQLite database."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            parent TEXT NOT NULL,
+            slug TEXT NOT NULL,
+            type TEXT NOT NULL,
+            modified TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (parent, slug)
+        );
+        CREATE INDEX IF NOT EXISTS entries_modified ON entries (modified);
+    """
+
+    def __init__(self, filename: str, legacy: str | None = None, export: str | None = None):
+        super().__init__(filename)
+
+        self.exported = export
+
+        created = not os.path.isfile(filename)
+
+        # The store is used by one thread at a time, but watching hands it over to the scheduler thread
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(self.SCHEMA)
+
+        # Existing JSON metadata is imported when the database is created
+        self.imported = legacy if created and legacy and os.path.isfile(legacy) else None
+
+        if self.imported:
+            self.mark_dirty()
+
+    def load(self) -> BaseMetadata:
+        if self.imported:
+            logging.info("Importing metadata from %s", self.imported)
+            return read_metadata(self.imported)
+
+        rows = self.connection.execute("SELECT parent, slug, type, data FROM entries ORDER BY rowid")
+
+        entries = {}
+
+        for parent, slug, kind, data in rows:
+            model = DirectoryMetadata if kind == "directory" else FileMetadata
+            entries[(parent, slug)] = model.model_validate_json(data)
+
+        metadata = BaseMetadata(root={})
+
+        # Entries are attached in insertion order, so directories keep the order of their content
+        for (parent, slug), entry in entries.items():
+            if not parent:
+                metadata.content[slug] = entry
+            elif isinstance(node := entries.get(os.path.split(parent)), DirectoryMetadata):
+                node.content[slug] = entry
+
+        return metadata
+
+    def save(self):
+        with self.connection:
+            if self.dirty:
+                self.connection.execute("DELETE FROM entries")
+                self.insert_tree(self.metadata.content, "")
+
+            else:
+                for path, slug in sorted(self.changed):
+                    self.update_entry(path, slug)
+
+        changes.written(self.filename)
+
+        if self.exported:
+            self.export(self.exported)
+
+    def insert_tree(self, content: dict, path: str):
+        """Insert all entries of a directory and its subdirectories."""
+
+        for slug, entry in content.items():
+            self.upsert(path, slug, entry)
+
+            if entry.type == "directory":
+                self.insert_tree(entry.content, os.path.join(path, slug))
+
+    def update_entry(self, path: str, slug: str):
+        """Write a single entry and its parent directories, or remove it if it no longer exists."""
+
+        content = self.metadata.content
+        parent = ""
+
+        for part in path.split(os.sep) if path else []:
+            if not isinstance(node := content.get(part), DirectoryMetadata):
+                return
+
+            # Parent directories are written too, so a new entry is never left without them
+            self.upsert(parent, part, node)
+            content, parent = node.content, os.path.join(parent, part)
+
+        if (entry := content.get(slug)) is not None:
+            self.upsert(path, slug, entry)
+            return
+
+        child = os.path.join(path, slug)
+        self.connection.execute("DELETE FROM entries WHERE parent = ? AND slug = ?", (path, slug))
+
+        # Content of removed directories is selected as a range of the primary key
+        self.connection.execute(
+            "DELETE FROM entries WHERE parent = ? OR (parent > ? AND parent < ?)",
+            (child, child + os.sep, child + chr(ord(os.sep) + 1)),
+        )
+
+    def upsert(self, path: str, slug: str, entry: DirectoryMetadata | FileMetadata):
+        """Insert or update a single entry without its content."""
+
+        self.connection.execute(
+            """
+            INSERT INTO entries (parent, slug, type, modified, data) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (parent, slug) DO UPDATE
+            SET type = excluded.type, modified = excluded.modified, data = excluded.data
+            """,
+            (
+                path,
+                slug,
+                entry.type,
+                getattr(entry, "modified", None),
+                entry.model_dump_json(exclude={"content"}),
+            ),
+        )
@@ -0,0 +1,45 @@
+import bisect
+
+from utils.models import DirectoryMetadata, FileMetadata
+
+
+def node_order(node: DirectoryMetadata | FileMetadata) -> tuple[int, str]:
+    """Return the sort key of a node, which puts directories first and then orders nodes by name."""
+
+    return 0 if node.type == "directory" else 1, node.name.lower()
+
+
+def sort_tree[T: dict](tree: T) -> T:
+    """Sort the whole tree, which is only needed for metadata that was not kept in order."""
+
+    if not isinstance(tree, dict):
+        return tree
+
+    modified = {}
+
+    for key, node in sorted(tree.items(), key=lambda item: node_order(item[1])):
+        if getattr(node, "type", None) == "directory":
+            node.content = sort_tree(node.content)
+        modified[key] = node
+
+    return modified
+
+
+def insert_node(tree: dict, slug: str, node: DirectoryMetadata | FileMetadata):
+    """Insert or replace a node in a sorted directory, keeping its order."""
+
+    # Replaced nodes that keep their name also keep their position
+    if slug in tree and node_order(tree[slug]) == node_order(node):
+        tree[slug] = node
+        return
+
+    tree.pop(slug, None)
+
+    items = list(tree.items())
+    position = bisect.bisect_right(items, node_order(node), key=lambda item: node_order(item[1]))
+
+    # Dictionaries can't insert at a position, so only this directory is rebuilt without sorting it
+    tree.clear()
+    tree.update(items[:position])
+    tree[slug] = node
+    tree.update(items[position:])